@@ -0,0 +1,120 @@
+# bench/fakes.py — faux serveurs Bot2 / TonAPI / Telegram Bot API pour les benchmarks
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import urlparse, parse_qs
+
+# 1x1 JPEG minimal, servi comme photo de profil
+FAKE_JPEG = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f"
+    "141d1a1f1e1d1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100"
+    "ffc4001f0000010501010101010100000000000000000102030405060708090a0bffda0008010100003f00d2cf20ffd9"
+)
+
+class FakeConfig:
+    def __init__(self, latency_ms:float=20, jitter_ms:float=10, error_rate:float=0.0, nft_count:int=50):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.nft_count = nft_count
+
+def _make_handler(kind:str, conf:FakeConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, comme les vrais amonts
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, code:int, body, content_type="application/json"):
+            data = body if isinstance(body, bytes) else json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _delay_or_fail(self) -> bool:
+            time.sleep(max(0.0, conf.latency_ms + random.uniform(-conf.jitter_ms, conf.jitter_ms)) / 1000)
+            if random.random() < conf.error_rate:
+                self._reply(503, {"ok": False, "error": "fake failure"})
+                return True
+            return False
+
+        def _body(self) -> dict:
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            if not raw:
+                return {}
+            try:
+                return json.loads(raw)
+            except ValueError:
+                return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+
+        def do_GET(self):
+            self._dispatch("GET", {})
+
+        def do_POST(self):
+            self._dispatch("POST", self._body())
+
+        def _dispatch(self, method:str, body:dict):
+            if self._delay_or_fail():
+                return
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            params.update(body)
+            if kind == "bot2":
+                if method == "POST":
+                    ids = params.get("telegram_ids") or []
+                    self._reply(200, {"totals": {str(i): int(i) % 97 for i in ids}})
+                else:
+                    self._reply(200, {"total_pioches": int(params.get("telegram_id") or 0) % 97})
+            elif kind == "tonapi":
+                items = [{"metadata": {"name": f"NFT #{i}", "image": f"https://img.example/{i}.png"}}
+                         for i in range(conf.nft_count)]
+                self._reply(200, {"nft_items": items})
+            else:
+                self._telegram(url.path, params)
+
+        def _telegram(self, path:str, params:dict):
+            if path.startswith("/file/"):
+                self._reply(200, FAKE_JPEG, "image/jpeg")
+                return
+            m = re.match(r"^/bot[^/]+/(\w+)$", path)
+            method = m.group(1) if m else ""
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                          "can_join_groups": False, "can_read_all_group_messages": False,
+                          "supports_inline_queries": False}
+            elif method == "getUserProfilePhotos":
+                uid = params.get("user_id")
+                result = {"total_count": 1, "photos": [[{"file_id": f"f{uid}", "file_unique_id": f"u{uid}",
+                                                          "width": 160, "height": 160}]]}
+            elif method == "getFile":
+                result = {"file_id": params.get("file_id"), "file_unique_id": "x", "file_path": "photos/p.jpg"}
+            elif method == "sendMessage":
+                result = {"message_id": random.randint(1, 1 << 30), "date": int(time.time()),
+                          "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+                          "text": params.get("text", "")}
+            elif method == "getUpdates":
+                time.sleep(1)
+                result = []
+            else:
+                result = True
+            self._reply(200, {"ok": True, "result": result})
+
+    return Handler
+
+def start_fake(kind:str, conf:FakeConfig, host:str="127.0.0.1") -> ThreadingHTTPServer:
+    # kind ∈ {"bot2", "tonapi", "telegram"} ; le serveur tourne dans un thread démon
+    server = ThreadingHTTPServer((host, 0), _make_handler(kind, conf))
+    server.daemon_threads = True
+    server.handle_error = lambda request, client_address: None   # connexions coupées à l’arrêt de l’app
+    Thread(target=server.serve_forever, daemon=True, name=f"fake-{kind}").start()
+    return server
+
+def base_url(server:ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
@@ -0,0 +1,160 @@
+# bench/run.py — benchmark de bout en bout : faux amonts + base pré-remplie + charge à RPS cible
+#
+#   python bench/run.py --users 10000,100000,1000000 --rps 200 --duration 20
+#
+# Pour chaque taille de base : démarre l’app (sous-processus, BOT_MODE=webhook) branchée
+# sur les faux serveurs de bench/fakes.py, envoie la charge (boucle ouverte) sur chaque
+# scénario, puis affiche débit et p50/p95/p99.
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import FakeConfig, start_fake, base_url   # noqa: E402
+from seed import seed                                 # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_SECRET = "bench-secret"
+SCENARIOS = ("api_me", "ton_submit", "avatar_update", "dashboard", "start")
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _start_update(i:int, uid:int) -> dict:
+    # Update Telegram "/start" tel que reçu en webhook
+    user = {"id": uid, "is_bot": False, "first_name": "bench", "username": f"user{uid}"}
+    return {"update_id": i, "message": {"message_id": i, "date": int(time.time()), "from": user,
+                                        "chat": {"id": uid, "type": "private"}, "text": "/start",
+                                        "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+
+def make_request(scenario:str, client:httpx.AsyncClient, i:int, n_users:int):
+    uid = random.randint(1, n_users)
+    if scenario == "api_me":
+        return client.get(f"/api/me?uid={uid}")
+    if scenario == "ton_submit":
+        return client.post("/ton/submit", json={"uid": uid, "address": f"EQbench{uid:010d}", "ref": ""})
+    if scenario == "avatar_update":
+        return client.post("/api/avatar/update", json={"uid": uid, "bracelet": random.choice(["metal", "leather"])})
+    if scenario == "dashboard":
+        return client.get(f"/dashboard?after={random.randint(0, n_users)}&limit=100")
+    if scenario == "start":
+        return client.post("/telegram/webhook", json=_start_update(i, uid),
+                           headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET})
+    raise ValueError(scenario)
+
+def percentile(sorted_values:list, p:float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+async def drive(base:str, scenario:str, rps:float, duration:float, n_users:int) -> dict:
+    # boucle ouverte : les requêtes partent à intervalle fixe, qu’elles aient abouti ou non
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=30) as client:
+        async def one(i:int):
+            nonlocal errors
+            t0 = time.perf_counter()
+            try:
+                r = await make_request(scenario, client, i, n_users)
+                if r.status_code >= 400:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - t0)
+
+        total = int(rps * duration)
+        start = time.perf_counter()
+        tasks = []
+        for i in range(total):
+            delay = start + i / rps - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(i)))
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "scenario": scenario, "users": n_users, "target_rps": rps, "requests": total,
+        "throughput": round(total / wall, 1), "errors": errors,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+def start_app(env:dict, port:int) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], env=env, cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"l’app s’est arrêtée (code {proc.returncode})")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("l’app n’a pas démarré à temps")
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark de bout en bout avec faux amonts")
+    ap.add_argument("--users", default="10000", help="tailles de base, ex: 10000,100000,1000000")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--rps", type=float, default=100)
+    ap.add_argument("--duration", type=float, default=10, help="secondes par scénario")
+    ap.add_argument("--latency-ms", type=float, default=20, help="latence moyenne des faux amonts")
+    ap.add_argument("--jitter-ms", type=float, default=10)
+    ap.add_argument("--error-rate", type=float, default=0.0, help="part de réponses 503 des faux amonts")
+    ap.add_argument("--nfts", type=int, default=50, help="NFT par wallet renvoyés par le faux TonAPI")
+    ap.add_argument("--json", help="écrit les résultats dans ce fichier")
+    ap.add_argument("--env", action="append", default=[], help="variable supplémentaire pour l’app, ex: DB_CACHE_KB=65536")
+    args = ap.parse_args()
+
+    conf = FakeConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.nfts)
+    bot2, tonapi, telegram = (start_fake(k, conf) for k in ("bot2", "tonapi", "telegram"))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_users in (int(x) for x in args.users.split(",")):
+            port = _free_port()
+            env = dict(os.environ,
+                       TELEGRAM_TOKEN="1:bench", PUBLIC_BASE_URL=f"http://127.0.0.1:{port}", BOT_USERNAME="bench_bot",
+                       API_SECRET="bench", BOT2_URL=f"{base_url(bot2)}/pioche", BOT2_BULK_URL=f"{base_url(bot2)}/bulk",
+                       TONAPI_KEY="bench", TONAPI_URL=base_url(tonapi), TELEGRAM_API_URL=base_url(telegram),
+                       BOT_MODE="webhook", WEBHOOK_SECRET=WEBHOOK_SECRET, PORT=str(port),
+                       DB_FILE=os.path.join(tmp, f"bench_{n_users}.db"),
+                       AVATAR_CACHE_DIR=os.path.join(tmp, f"avatars_{n_users}"),
+                       TROPHY_SYNC_INTERVAL="0")
+            env.update(kv.split("=", 1) for kv in args.env)
+            # migrations de l’app, puis remplissage
+            subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "migrate"], env=env, cwd=ROOT, check=True)
+            print(f"[{n_users} users] seed: {seed(env['DB_FILE'], n_users):.1f}s", flush=True)
+            proc = start_app(env, port)
+            try:
+                for scenario in args.scenarios.split(","):
+                    res = asyncio.run(drive(f"http://127.0.0.1:{port}", scenario, args.rps, args.duration, n_users))
+                    results.append(res)
+                    print(f"[{n_users} users] {scenario:14s} {res['throughput']:8.1f} req/s  "
+                          f"p50 {res['p50_ms']:7.1f} ms  p95 {res['p95_ms']:7.1f} ms  p99 {res['p99_ms']:7.1f} ms  "
+                          f"errors {res['errors']}", flush=True)
+            finally:
+                proc.terminate()
+                proc.wait(timeout=10)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# bench/seed.py — remplit la table users (10k / 100k / 1M lignes) pour les benchmarks
+import argparse
+import os
+import random
+import sqlite3
+import string
+import subprocess
+import sys
+import time
+
+def _code(i:int) -> str:
+    # personal_code unique et déterministe (6 caractères comme generate_referral_code)
+    alphabet = string.ascii_uppercase + string.digits
+    out = []
+    for _ in range(6):
+        i, r = divmod(i, len(alphabet))
+        out.append(alphabet[r])
+    return "".join(out)
+
+def seed(db_file:str, n_users:int, chunk:int=50_000, referral_rate:float=0.3):
+    # la base doit avoir été initialisée par l’app (python main.py migrate)
+    cx = sqlite3.connect(db_file)
+    cx.execute("PRAGMA journal_mode=WAL")
+    cx.execute("PRAGMA synchronous=OFF")
+    rnd = random.Random(42)
+    t0 = time.perf_counter()
+    for start in range(1, n_users + 1, chunk):
+        rows = []
+        for uid in range(start, min(start + chunk, n_users + 1)):
+            ref = _code(rnd.randint(1, uid - 1)) if uid > 1 and rnd.random() < referral_rate else None
+            rows.append((uid, f"user{uid}", f"EQbench{uid:010d}", _code(uid), ref, rnd.randint(0, 500)))
+        cx.executemany("""INSERT OR IGNORE INTO users
+                          (telegram_id, username, wallet_address, personal_code, referral_code_used, trophies_total)
+                          VALUES (?, ?, ?, ?, ?, ?)""", rows)
+        cx.commit()
+    cx.execute("ANALYZE")
+    cx.close()
+    rebuild(db_file)
+    return time.perf_counter() - t0
+
+def rebuild(db_file:str):
+    # tables dérivées (classement, parrainage) recalculées par l’app : migrate ne le refait pas
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, os.path.join(root, "main.py"), "rebuild"], cwd=root, check=True,
+                   env=dict(os.environ, DB_FILE=os.path.abspath(db_file)), stdout=subprocess.DEVNULL)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Remplit users pour les benchmarks")
+    ap.add_argument("db_file")
+    ap.add_argument("--users", type=int, default=10_000)
+    args = ap.parse_args()
+    print(f"seeded {args.users} users in {seed(args.db_file, args.users):.1f}s")
@@ -0,0 +1,74 @@
+# bench/startup.py — coût de démarrage d’un worker (pré-fork, scripts, outils)
+#
+#   python bench/startup.py --runs 20
+#   python bench/startup.py --runs 20 --json startup.json
+#
+# Chaque mesure tourne dans un processus Python neuf (caches d’import froids côté
+# interpréteur, pas de .pyc partagé en mémoire) sur une base déjà migrée, et chronomètre :
+# import de main, create_app(), première requête, construction du bot PTB et migrate()
+# sur une base à jour.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t_import = time.perf_counter()
+app = main.create_app()
+t_app = time.perf_counter()
+assert app.test_client().get("/").status_code == 200
+t_first = time.perf_counter()
+main.get_application()
+t_bot = time.perf_counter()
+main.migrate()
+t_migrate = time.perf_counter()
+json.dump({"import": t_import - t0, "create_app": t_app - t_import, "first_request": t_first - t_app,
+           "bot": t_bot - t_first, "migrate_noop": t_migrate - t_bot}, sys.stdout)
+"""
+
+STEPS = ("import", "create_app", "first_request", "bot", "migrate_noop")
+
+def _pct(values:list[float], p:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--json", help="écrit les résultats dans ce fichier")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   TELEGRAM_TOKEN="123456:bench", PUBLIC_BASE_URL="https://bench.invalid",
+                   BOT_USERNAME="bench_bot", DB_FILE=os.path.join(tmp, "startup.db"))
+        subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "migrate"], env=env, cwd=ROOT,
+                       check=True, stdout=subprocess.DEVNULL)
+        samples = []
+        for _ in range(args.runs):
+            out = subprocess.run([sys.executable, "-c", PROBE], env=env, cwd=ROOT,
+                                 check=True, capture_output=True, text=True).stdout
+            samples.append(json.loads(out))
+
+    results = {}
+    print(f"{'étape':<14} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for step in STEPS + ("total",):
+        values = [sum(s.values()) if step == "total" else s[step] for s in samples]
+        results[step] = {"p50": _pct(values, 50), "p95": _pct(values, 95), "max": max(values),
+                         "mean": statistics.fmean(values)}
+        r = results[step]
+        print(f"{step:<14} {r['p50'] * 1000:8.1f} {r['p95'] * 1000:8.1f} {r['max'] * 1000:8.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"runs": args.runs, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,25 @@
 import os
 import json
 import sqlite3
+import io
+import csv
+import hashlib
+import gzip
+import mimetypes
+import time
+import queue
+import asyncio
+import atexit
 import secrets
-import requests
-from threading import Thread
+import httpx
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from threading import Thread, Lock, Event, local
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from flask import (
-    Flask, request, jsonify, render_template, render_template_string,
-    redirect, make_response
+    Flask, Blueprint, current_app, request, jsonify, g, render_template_string,
+    redirect, make_response, send_file, abort, Response, stream_with_context
 )
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, Update
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
@@ -21,22 +34,102 @@ FLASK_SECRET   = os.getenv("FLASK_SECRET", "please-set-flask-secret")
 BOT_USERNAME   = os.getenv("BOT_USERNAME", "")  # sans @, ex: Labail_bot
 API_SECRET     = os.getenv("API_SECRET", "")
 BOT2_URL       = os.getenv("BOT2_URL", "")      # ex: https://bot2.example.com/pioche
+BOT2_BULK_URL  = os.getenv("BOT2_BULK_URL", "") # optionnel, ex: https://bot2.example.com/pioches/bulk
 TONAPI_KEY     = os.getenv("TONAPI_KEY", "")    # optionnel (TonAPI)
+TONAPI_URL       = os.getenv("TONAPI_URL", "https://tonapi.io").rstrip("/")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")  # ex: serveur local de bench
+UPSTREAM_WORKERS = int(os.getenv("UPSTREAM_WORKERS", "16"))    # threads pour les appels amont
+API_ME_DEADLINE  = float(os.getenv("API_ME_DEADLINE", "4"))   # délai global /api/me (secondes)
+REFRESH_WORKERS  = int(os.getenv("REFRESH_WORKERS", "8"))     # threads de rafraîchissement des caches
+BOT2_CACHE_TTL   = float(os.getenv("BOT2_CACHE_TTL", "60"))    # fraîcheur des trophées Bot2 (s)
+BOT2_CACHE_STALE = float(os.getenv("BOT2_CACHE_STALE", "600")) # servis périmés pendant le rafraîchissement (s)
+BOT2_CACHE_MAX   = int(os.getenv("BOT2_CACHE_MAX", "50000"))   # nombre max d'utilisateurs en cache (LRU)
+ME_CACHE_TTL     = float(os.getenv("ME_CACHE_TTL", "3"))       # cache des réponses /api/me (s), 0 = désactivé
+ME_CACHE_MAX     = int(os.getenv("ME_CACHE_MAX", "10000"))
+NFT_CACHE_TTL        = int(os.getenv("NFT_CACHE_TTL", "900"))         # âge max d'une entrée nft_cache (s)
+NFT_REFRESH_INTERVAL = float(os.getenv("NFT_REFRESH_INTERVAL", "30")) # période du rafraîchisseur NFT (s)
+NFT_REFRESH_BATCH    = int(os.getenv("NFT_REFRESH_BATCH", "50"))      # wallets rafraîchis par passage
+NFT_RETRY_BASE       = int(os.getenv("NFT_RETRY_BASE", "300"))        # 1er délai après un échec TonAPI (s), doublé ensuite
+NFT_RETRY_MAX        = int(os.getenv("NFT_RETRY_MAX", "86400"))       # délai max entre deux essais d’un wallet en échec
+SERVER_MODE          = os.getenv("SERVER_MODE", "thread")   # thread (Flask + run_polling) | asgi (uvicorn + bot sur la même boucle)
+ASGI_WSGI_WORKERS    = int(os.getenv("ASGI_WSGI_WORKERS", "64"))  # mode asgi : vues Flask exécutées en parallèle
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))  # connexions max par client httpx
+HTTP_MAX_KEEPALIVE   = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))     # connexions gardées ouvertes
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")) # durée de vie d'une connexion inactive (s)
+BOT_MODE             = os.getenv("BOT_MODE", "polling")     # polling | webhook
+WEBHOOK_PATH         = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET       = os.getenv("WEBHOOK_SECRET", "")      # en-tête X-Telegram-Bot-Api-Secret-Token
+BOT_CONCURRENCY      = int(os.getenv("BOT_CONCURRENCY", "1"))   # updates traités en parallèle (1 = un par un)
+BOT_DB_WORKERS       = int(os.getenv("BOT_DB_WORKERS", "8"))    # threads pour le travail DB des handlers du bot
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "0"))  # écritures profil différées (s), 0 = immédiates
+WRITE_BEHIND_MAX      = int(os.getenv("WRITE_BEHIND_MAX", "1000"))      # écriture anticipée dès N utilisateurs en attente
+METRICS_TOKEN        = os.getenv("METRICS_TOKEN", "")       # optionnel : Authorization: Bearer pour /metrics
+REFERRAL_MAX_DEPTH     = int(os.getenv("REFERRAL_MAX_DEPTH", "3"))   # niveaux de parrainage comptés
+TROPHY_SYNC_INTERVAL    = float(os.getenv("TROPHY_SYNC_INTERVAL", "900"))  # pause entre deux passes (s), 0 = désactivé
+TROPHY_SYNC_CHUNK       = int(os.getenv("TROPHY_SYNC_CHUNK", "500"))       # utilisateurs par paquet
+TROPHY_SYNC_CONCURRENCY = int(os.getenv("TROPHY_SYNC_CONCURRENCY", "8"))   # appels unitaires simultanés (repli)
+TROPHY_SYNC_RPS         = float(os.getenv("TROPHY_SYNC_RPS", "20"))        # budget de requêtes Bot2 par seconde
+TROPHY_PUSH_FLUSH       = float(os.getenv("TROPHY_PUSH_FLUSH", "1"))       # délai max avant écriture d’un push Bot2 (s)
+TROPHY_PUSH_BATCH       = int(os.getenv("TROPHY_PUSH_BATCH", "2000"))      # écriture anticipée dès N utilisateurs en attente
+TROPHY_PUSH_MAX_BYTES   = int(os.getenv("TROPHY_PUSH_MAX_BYTES", str(4 * 1024 * 1024)))  # taille max d’un push
+TROPHY_PUSH_LEGACY_MAX_BYTES = int(os.getenv("TROPHY_PUSH_LEGACY_MAX_BYTES", "65536"))  # idem avec le secret dans le corps
+BOT2_PUSH               = os.getenv("BOT2_PUSH", "0") == "1"               # Bot2 pousse les trophées : /api/me ne l’appelle plus
+LEADERBOARD_TTL        = float(os.getenv("LEADERBOARD_TTL", "30"))   # cache mémoire du haut de classement (s)
+LEADERBOARD_TOP_MAX    = int(os.getenv("LEADERBOARD_TOP_MAX", "100"))
+AVATAR_CACHE_DIR       = os.getenv("AVATAR_CACHE_DIR", "avatar_cache")
+AVATAR_CACHE_MAX_BYTES = int(os.getenv("AVATAR_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))  # taille max du cache disque
+AVATAR_RECHECK         = float(os.getenv("AVATAR_RECHECK", "3600"))     # vérif. du file_id Telegram (s)
+AVATAR_MAX_AGE         = int(os.getenv("AVATAR_MAX_AGE", str(7 * 86400)))  # Cache-Control navigateur (s)
+OUTBOX_GLOBAL_RATE   = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))   # messages/s tous chats confondus
+OUTBOX_CHAT_RATE     = float(os.getenv("OUTBOX_CHAT_RATE", "1"))      # messages/s par chat
+OUTBOX_BATCH         = int(os.getenv("OUTBOX_BATCH", "100"))          # messages réservés par passage
+OUTBOX_MAX_ATTEMPTS  = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_LEASE         = float(os.getenv("OUTBOX_LEASE", "60"))         # réservation d'un message en cours d'envoi (s)
 
-if not TELEGRAM_TOKEN:
-    raise RuntimeError("TELEGRAM_TOKEN manquant.")
-if not PUBLIC_BASE_URL:
-    raise RuntimeError("PUBLIC_BASE_URL manquant (doit être HTTPS).")
-if not BOT_USERNAME:
-    raise RuntimeError("BOT_USERNAME manquant (sans @).")
+DB_AUTO_MIGRATE      = os.getenv("DB_AUTO_MIGRATE", "1") == "1"   # python main.py applique les migrations au démarrage
+
+def check_config():
+    # vérifié à la création de l’app web / du bot, pas à l’import (migrate, outils, bench)
+    if not TELEGRAM_TOKEN:
+        raise RuntimeError("TELEGRAM_TOKEN manquant.")
+    if not PUBLIC_BASE_URL:
+        raise RuntimeError("PUBLIC_BASE_URL manquant (doit être HTTPS).")
+    if not BOT_USERNAME:
+        raise RuntimeError("BOT_USERNAME manquant (sans @).")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET manquant (requis en BOT_MODE=webhook).")
 
 # =========================
-# Flask
+# Flask (app factory)
 # =========================
-app = Flask(__name__)
-app.secret_key = FLASK_SECRET
+# Rien n’est créé à l’import : les routes vivent sur un Blueprint, l’app Flask,
+# le bot PTB, la DB et les clients HTTP sont construits au premier usage.
+# `main:app` (gunicorn, scripts) reste valable via __getattr__ en fin de module.
+bp = Blueprint("bot", __name__)
+
+def create_app() -> Flask:
+    check_config()
+    # static/ est servi depuis la mémoire (serve_static), pas par la route par défaut de Flask
+    app = Flask(__name__, static_folder=None)
+    app.secret_key = FLASK_SECRET
+    app.register_blueprint(bp)
+    app.extensions["assets"] = build_assets(app)
+    return app
+
+_app = None
+_app_lock = Lock()
 
-@app.route("/")
+def get_app() -> Flask:
+    global _app
+    with _app_lock:
+        if _app is None:
+            _app = create_app()
+    start_workers()
+    if BOT_MODE == "webhook":
+        start_bot()
+    return _app
+
+@bp.route("/")
 def root_ok():
     return "OK", 200
 
@@ -46,7 +139,7 @@ ICON_BYTES = bytes.fromhex(
     "1F15C4890000000A49444154789C6360000002000154A24F6500000000"
     "49454E44AE426082"
 )
-@app.route("/static/ton-icon.png")
+@bp.route("/static/ton-icon.png")
 def ton_icon():
     resp = make_response(ICON_BYTES)
     resp.headers["Content-Type"] = "image/png"
@@ -54,7 +147,7 @@ def ton_icon():
     return resp
 
 # Manifest TON Connect
-@app.route("/ton/manifest.json")
+@bp.route("/ton/manifest.json")
 def ton_manifest():
     return jsonify({
         "url": PUBLIC_BASE_URL,
@@ -64,25 +157,458 @@ def ton_manifest():
         "privacyPolicyUrl": f"{PUBLIC_BASE_URL}/privacy"
     })
 
-@app.route("/.well-known/tonconnect-manifest.json")
+@bp.route("/.well-known/tonconnect-manifest.json")
 def ton_manifest_wk():
     return ton_manifest()
 
-@app.route("/manifest.json")
+@bp.route("/manifest.json")
 def ton_manifest_alias():
     return ton_manifest()
 
-@app.route("/ton/manifest.sjon")
+@bp.route("/ton/manifest.sjon")
 def ton_manifest_typo():
     return redirect("/ton/manifest.json", code=302)
 
+# =========================
+# Assets pré-rendus et précompressés (app.html, static/, /api/mines)
+# =========================
+# Construits une fois par create_app() : rendu Jinja, gzip (et brotli si le module
+# est installé), ETag = empreinte du contenu. Servis depuis la mémoire selon
+# Accept-Encoding ; une réouverture de la WebApp ne coûte qu’un 304.
+try:
+    import brotli   # optionnel (pip install brotli)
+except ImportError:
+    brotli = None
+
+ASSET_MIN_GAIN = 0.9                 # variante compressée gardée si < 90 % de l’original
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+MINES = [
+    {"title":"Mine 1","url":"https://t.me/mine1"},
+    {"title":"Mine 2","url":"https://t.me/mine2"},
+    {"title":"Mine 3","url":"https://t.me/mine3"},
+]
+
+class Asset:
+    def __init__(self, body:bytes, content_type:str, cache_control:str):
+        self.content_type, self.cache_control = content_type, cache_control
+        self.hash = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {"identity": body}
+        compressed = {"gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(body, quality=11)
+        for encoding, data in compressed.items():
+            if len(data) < len(body) * ASSET_MIN_GAIN:
+                self.variants[encoding] = data
+
+    def etag(self, encoding:str) -> str:
+        return self.hash if encoding == "identity" else f"{self.hash}-{encoding}"
+
+def build_assets(app:Flask) -> dict[str, Asset]:
+    assets = {}
+    static_dir = os.path.join(app.root_path, "static")
+    for dirpath, _, files in os.walk(static_dir):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, static_dir).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                assets[f"static/{rel}"] = Asset(f.read(), mimetypes.guess_type(name)[0] or "application/octet-stream",
+                                                IMMUTABLE)
+    # app.html ne prend pas de contexte : rendu une fois, avec des URL static versionnées (?v=empreinte)
+    def static_url(name:str) -> str:
+        return f"/static/{name}?v={assets['static/' + name].hash}"
+    html = app.jinja_env.get_template("app.html").render(static_url=static_url)
+    assets["app.html"] = Asset(html.encode(), "text/html; charset=utf-8", "no-cache")
+    assets["api/mines"] = Asset(json.dumps({"mines": MINES}).encode(), "application/json", "public, max-age=600")
+    return assets
+
+def serve_asset(key:str, cache_control:str|None=None) -> Response:
+    asset = current_app.extensions["assets"].get(key)
+    if asset is None:
+        abort(404)
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in asset.variants and request.accept_encodings.quality(candidate) > 0:
+            encoding = candidate
+            break
+    etag = asset.etag(encoding)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(asset.variants[encoding], content_type=asset.content_type)
+        if encoding != "identity":
+            resp.headers["Content-Encoding"] = encoding
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control or asset.cache_control
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+@bp.route("/static/<path:filename>")
+def serve_static(filename:str):
+    # immuable seulement pour l’URL versionnée ; sans ?v= le client revalide (304)
+    asset = current_app.extensions["assets"].get(f"static/{filename}")
+    versioned = asset is not None and request.args.get("v") == asset.hash
+    return serve_asset(f"static/{filename}", None if versioned else "no-cache")
+
+# =========================
+# Métriques (format texte Prometheus sur /metrics)
+# =========================
+# Mesure = quelques additions sous verrou ; le rendu texte n’est fait qu’au scrape.
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(names:tuple, values:tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values)) + "}"
+
+class CounterMetric:
+    def __init__(self, name:str, help_text:str, labels:tuple=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._values = {}
+        self._lock = Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, n:float=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + n
+
+    def value(self, *label_values) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                out.append(f"{self.name}{_labels(self.labels, key)} {v}")
+        return out
+
+class HistogramMetric:
+    def __init__(self, name:str, help_text:str, labels:tuple=(), buckets:tuple=METRIC_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self._series = {}   # label_values -> [compte par bucket..., somme, total]
+        self._lock = Lock()
+        METRICS.append(self)
+
+    def observe(self, value:float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def totals(self, *label_values) -> tuple[int, float]:
+        # (nombre d’observations, somme)
+        with self._lock:
+            series = self._series.get(label_values)
+            return (series[-1], series[-2]) if series else (0, 0.0)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, series):
+                    cumulative += n
+                    out.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + (bound,))} {cumulative}")
+                out.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + ('+Inf',))} {series[-1]}")
+                out.append(f"{self.name}_sum{_labels(self.labels, key)} {series[-2]}")
+                out.append(f"{self.name}_count{_labels(self.labels, key)} {series[-1]}")
+        return out
+
+METRICS: list = []
+http_latency = HistogramMetric("http_request_duration_seconds", "Durée des requêtes HTTP par route", ("route", "method"))
+http_requests = CounterMetric("http_requests_total", "Requêtes HTTP par route et statut", ("route", "status"))
+upstream_latency = HistogramMetric("upstream_request_duration_seconds", "Durée des appels amont", ("upstream",))
+upstream_errors = CounterMetric("upstream_errors_total", "Appels amont en échec (réseau, 5xx, réponse invalide)", ("upstream",))
+upstream_retries = CounterMetric("upstream_retries_total", "Nouveaux essais d’appels amont", ("upstream",))
+db_latency = HistogramMetric("sqlite_query_duration_seconds", "Durée des requêtes DB (SQLite ou PostgreSQL) par type", ("op",))
+cache_requests = CounterMetric("cache_requests_total", "Accès aux caches", ("cache", "result"))
+bot_latency = HistogramMetric("bot_handler_duration_seconds", "Durée des handlers du bot", ("handler",))
+
+@bp.before_app_request
+def _metrics_start():
+    g.t0 = time.perf_counter()
+
+@bp.after_app_request
+def _metrics_record(resp):
+    t0 = g.pop("t0", None)
+    if t0 is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        http_latency.observe(time.perf_counter() - t0, route, request.method)
+        http_requests.inc(route, resp.status_code)
+    return resp
+
+@bp.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return ("forbidden", 403)
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
 # =========================
 # DB
 # =========================
 DB_FILE = os.getenv("DB_FILE", "bot.db")
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-c = conn.cursor()
-c.execute("""
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))    # attente max du verrou d'écriture (s)
+DB_CACHE_KB     = int(os.getenv("DB_CACHE_KB", "16384"))       # cache de pages par connexion
+DB_MMAP_BYTES   = int(os.getenv("DB_MMAP_BYTES", str(128 * 1024 * 1024)))
+DB_STMT_CACHE   = int(os.getenv("DB_STMT_CACHE", "256"))       # requêtes préparées gardées par connexion
+DB_IDLE_MAX     = int(os.getenv("DB_IDLE_MAX", "32"))          # connexions SQLite gardées ouvertes entre deux requêtes
+# Stockage : vide = fichier SQLite local (DB_FILE) ; postgresql://... = base serveur partagée
+# par plusieurs répliques (dépendance optionnelle : psycopg[binary] + psycopg_pool).
+DATABASE_URL    = os.getenv("DATABASE_URL", "")
+DB_POOL_MIN     = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX     = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))    # attente max d'une connexion libre (s)
+DB_IS_PG        = DATABASE_URL.startswith(("postgres://", "postgresql://"))
+if DATABASE_URL and not DB_IS_PG:
+    raise RuntimeError("DATABASE_URL doit commencer par postgresql:// (vide = SQLite).")
+
+# Une connexion par thread (Flask, bot, workers) au lieu d’un curseur global partagé.
+# WAL : les lectures (/api/me, /dashboard) n’attendent pas derrière les écritures.
+# Le SQL est écrit pour passer tel quel sur SQLite et PostgreSQL (placeholders ? traduits) ;
+# seuls le schéma et quelques fragments (SQL_*) diffèrent.
+_db_local = local()
+
+class TimedConnection(sqlite3.Connection):
+    # chronomètre chaque requête (label = premier mot SQL : SELECT, INSERT, ...)
+    def execute(self, sql, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            db_latency.observe(time.perf_counter() - t0, sql.lstrip().split(None, 1)[0].upper())
+
+    def executemany(self, sql, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            db_latency.observe(time.perf_counter() - t0, sql.lstrip().split(None, 1)[0].upper())
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            db_latency.observe(time.perf_counter() - t0, "COMMIT")
+
+    def begin(self):
+        # prend le verrou d’écriture tout de suite : pas d’échec à la promotion lecture → écriture
+        self.execute("BEGIN IMMEDIATE")
+
+@lru_cache(maxsize=1024)
+def _pg_sql(sql:str) -> str:
+    return sql.replace("%", "%%").replace("?", "%s")
+
+class PgResult:
+    # résultat déjà lu (la connexion est rendue au pool avant le retour)
+    def __init__(self, rows:list, rowcount:int):
+        self._rows, self.rowcount = rows, rowcount
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+class PgConnection:
+    # même interface que TimedConnection pour ce qu’utilise le code. Hors transaction chaque
+    # requête emprunte une connexion du pool (autocommit) ; entre begin() et commit()/rollback()
+    # la connexion reste attachée au thread.
+    def __init__(self, pool):
+        self.pool = pool
+        self._conn = None
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._conn is not None
+
+    def _run(self, conn, sql:str, params, many:bool):
+        cur = conn.cursor()
+        if many:
+            cur.executemany(_pg_sql(sql), params)
+        else:
+            cur.execute(_pg_sql(sql), params)
+        return cur
+
+    def _timed(self, sql:str, params, many:bool):
+        t0 = time.perf_counter()
+        try:
+            if self._conn is not None:
+                return self._run(self._conn, sql, params, many)
+            with self.pool.connection() as conn:
+                cur = self._run(conn, sql, params, many)
+                return PgResult(cur.fetchall() if cur.description else [], cur.rowcount)
+        finally:
+            db_latency.observe(time.perf_counter() - t0, sql.lstrip().split(None, 1)[0].upper())
+
+    def execute(self, sql:str, params=()):
+        return self._timed(sql, params, False)
+
+    def executemany(self, sql:str, seq):
+        return self._timed(sql, list(seq), True)
+
+    def begin(self):
+        self._conn = self.pool.getconn()
+        try:
+            self._conn.execute("BEGIN")
+        except Exception:
+            self._release()
+            raise
+
+    def commit(self):
+        if self._conn is None:
+            return
+        from psycopg.pq import TransactionStatus
+        t0 = time.perf_counter()
+        try:
+            if self._conn.info.transaction_status == TransactionStatus.INERROR:
+                # une requête a échoué dans la transaction : COMMIT annulerait en silence
+                self._conn.execute("ROLLBACK")
+                raise RuntimeError("transaction annulée après une erreur SQL")
+            self._conn.execute("COMMIT")
+        finally:
+            self._release()
+            db_latency.observe(time.perf_counter() - t0, "COMMIT")
+
+    def rollback(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute("ROLLBACK")
+        finally:
+            self._release()
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        self.pool.putconn(conn)
+
+_pg_pool = None
+_pg_pool_lock = Lock()
+
+def pg_pool():
+    global _pg_pool
+    with _pg_pool_lock:
+        if _pg_pool is None:
+            try:
+                from psycopg_pool import ConnectionPool
+            except ImportError:
+                raise RuntimeError("DATABASE_URL=postgresql://... requiert psycopg[binary] et psycopg_pool.")
+            _pg_pool = ConnectionPool(DATABASE_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+                                      timeout=DB_POOL_TIMEOUT, kwargs={"autocommit": True}, open=True)
+        return _pg_pool
+
+# fragments qui diffèrent entre SQLite et PostgreSQL
+if DB_IS_PG:
+    SQL_USERNAME_PREFIX = "lower(username) LIKE lower(?)"   # idx_users_username (lower, text_pattern_ops)
+    SQL_SKIP_LOCKED = " FOR UPDATE SKIP LOCKED"             # répliques : pas deux baux sur un même message
+    SQL_FOR_UPDATE = " FOR UPDATE"                          # lecture puis écriture : lignes verrouillées jusqu’au COMMIT
+else:
+    SQL_USERNAME_PREFIX = "username LIKE ?"                  # LIKE insensible à la casse, idx NOCASE
+    SQL_SKIP_LOCKED = ""
+    SQL_FOR_UPDATE = ""                                      # BEGIN IMMEDIATE sérialise déjà les écritures
+
+def db():
+    # base principale (tables partagées) : SQLite local ou PostgreSQL selon DATABASE_URL
+    if not DB_IS_PG:
+        return local_db()
+    cx = getattr(_db_local, "pg", None)
+    if cx is None:
+        cx = _db_local.pg = PgConnection(pg_pool())
+    return cx
+
+# Le serveur Flask lance un thread par requête : la connexion d’un thread de requête
+# est rendue à _sqlite_idle en fin de requête (release_local_db) et reprise par la
+# suivante, avec ses PRAGMA et son cache de requêtes préparées. Les threads longs
+# (workers, pool du bot) gardent la leur.
+_sqlite_idle = queue.LifoQueue()
+
+def local_db() -> sqlite3.Connection:
+    # SQLite du processus : tout en mode SQLite, seulement avatar_cache (fichiers locaux) en mode PostgreSQL
+    cx = getattr(_db_local, "conn", None)
+    if cx is None:
+        try:
+            cx = _db_local.conn = _sqlite_idle.get_nowait()
+            return cx
+        except queue.Empty:
+            pass
+        cx = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT, factory=TimedConnection,
+                             cached_statements=DB_STMT_CACHE, check_same_thread=False)
+        cx.execute("PRAGMA journal_mode=WAL")
+        cx.execute("PRAGMA synchronous=NORMAL")    # sûr en WAL, un fsync par checkpoint
+        cx.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+        cx.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        cx.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES}")
+        cx.execute("PRAGMA temp_store=MEMORY")
+        if DB_IS_PG:
+            # cache propre au processus, hors migrations partagées
+            for ddl in AVATAR_SCHEMA:
+                cx.execute(ddl)
+        _db_local.conn = cx
+    return cx
+
+def release_local_db():
+    # fin de requête : la connexion SQLite du thread retourne au pool (au plus DB_IDLE_MAX gardées)
+    cx = getattr(_db_local, "conn", None)
+    if cx is None:
+        return
+    del _db_local.conn
+    if cx.in_transaction:
+        cx.rollback()
+    if _sqlite_idle.qsize() < DB_IDLE_MAX:
+        _sqlite_idle.put(cx)
+    else:
+        cx.close()
+
+@bp.teardown_app_request
+def _release_db(exc=None):
+    release_local_db()
+
+# Une transaction par requête/handler plutôt qu’un commit par helper : les helpers
+# d’écriture ouvrent tx(), imbriqué dans celui de l’appelant s’il y en a un ; seul
+# le tx() le plus externe fait BEGIN IMMEDIATE / COMMIT. Les effets mémoire (caches,
+# réveil de workers) passent par after_commit() et ne sont vus qu’après le COMMIT.
+@contextmanager
+def tx():
+    cx = db()
+    depth = getattr(_db_local, "tx_depth", 0)
+    if depth == 0:
+        _db_local.tx_after = []
+        if not cx.in_transaction:
+            cx.begin()
+    _db_local.tx_depth = depth + 1
+    try:
+        yield cx
+    except BaseException:
+        _db_local.tx_depth = depth
+        if depth == 0:
+            _db_local.tx_after = []
+            cx.rollback()
+        raise
+    _db_local.tx_depth = depth
+    if depth == 0:
+        cx.commit()
+        after, _db_local.tx_after = _db_local.tx_after, []
+        for fn, args in after:
+            fn(*args)
+
+def after_commit(fn, *args):
+    if getattr(_db_local, "tx_depth", 0):
+        _db_local.tx_after.append((fn, args))
+    else:
+        fn(*args)
+
+def init_sqlite_schema(cx):
+    cx.execute("""
 CREATE TABLE IF NOT EXISTS users (
     telegram_id INTEGER PRIMARY KEY,
     username TEXT,
@@ -98,98 +624,977 @@ CREATE TABLE IF NOT EXISTS users (
     profile_photo_path TEXT
 )
 """)
-conn.commit()
+    # NFT TonAPI déjà réduits en [{name, image}] (JSON), par wallet
+    cx.execute("""
+CREATE TABLE IF NOT EXISTS nft_cache (
+    wallet_address TEXT PRIMARY KEY,
+    items TEXT NOT NULL,
+    fetched_at INTEGER NOT NULL
+)
+""")
+    # messages Telegram en attente d’envoi (survit aux redémarrages)
+    cx.execute("""
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    reply_markup TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    created_at REAL NOT NULL
+)
+""")
+    cx.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_at ON outbox(next_at)")
+    # recherche dashboard (préfixe username insensible à la casse, préfixe wallet)
+    cx.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE)")
+    cx.execute("CREATE INDEX IF NOT EXISTS idx_users_wallet ON users(wallet_address)")
+    # parrainage : filleuls directs d’un code + compteurs matérialisés par niveau
+    cx.execute("CREATE INDEX IF NOT EXISTS idx_users_referral_code_used ON users(referral_code_used)")
+    cx.execute("""
+CREATE TABLE IF NOT EXISTS referral_counts (
+    telegram_id INTEGER NOT NULL,   -- parrain
+    depth INTEGER NOT NULL,         -- 1 = filleuls directs, 2 = filleuls des filleuls, ...
+    invited INTEGER NOT NULL,
+    PRIMARY KEY (telegram_id, depth)
+) WITHOUT ROWID
+""")
+    cx.execute("CREATE INDEX IF NOT EXISTS idx_referral_counts_top ON referral_counts(depth, invited DESC)")
+    # points de reprise des tâches de fond (ex: synchro trophées)
+    cx.execute("""
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT,
+    updated_at REAL
+)
+""")
+    # classement : index pour le top, histogramme (trophées → nb d’utilisateurs) pour le rang
+    cx.execute("CREATE INDEX IF NOT EXISTS idx_users_trophies ON users(trophies_total DESC, telegram_id)")
+    cx.execute("""
+CREATE TABLE IF NOT EXISTS trophy_histogram (
+    trophies INTEGER PRIMARY KEY,
+    users INTEGER NOT NULL
+)
+""")
+
+PG_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS users (
+    telegram_id BIGINT PRIMARY KEY,
+    username TEXT,
+    wallet_address TEXT,
+    personal_code TEXT UNIQUE,
+    referral_code_used TEXT,
+    trophies_total INTEGER DEFAULT 0,
+    hat TEXT DEFAULT 'none',
+    jacket TEXT DEFAULT 'none',
+    pants TEXT DEFAULT 'none',
+    shoes TEXT DEFAULT 'none',
+    bracelet TEXT DEFAULT 'metal',
+    profile_photo_path TEXT
+)""",
+    """CREATE TABLE IF NOT EXISTS nft_cache (
+    wallet_address TEXT PRIMARY KEY,
+    items TEXT NOT NULL,
+    fetched_at BIGINT NOT NULL
+)""",
+    """CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    text TEXT NOT NULL,
+    reply_markup TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at DOUBLE PRECISION NOT NULL,
+    created_at DOUBLE PRECISION NOT NULL
+)""",
+    "CREATE INDEX IF NOT EXISTS idx_outbox_next_at ON outbox(next_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_username ON users(lower(username) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_users_wallet ON users(wallet_address)",
+    "CREATE INDEX IF NOT EXISTS idx_users_referral_code_used ON users(referral_code_used)",
+    """CREATE TABLE IF NOT EXISTS referral_counts (
+    telegram_id BIGINT NOT NULL,
+    depth INTEGER NOT NULL,
+    invited INTEGER NOT NULL,
+    PRIMARY KEY (telegram_id, depth)
+)""",
+    "CREATE INDEX IF NOT EXISTS idx_referral_counts_top ON referral_counts(depth, invited DESC)",
+    """CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT,
+    updated_at DOUBLE PRECISION
+)""",
+    "CREATE INDEX IF NOT EXISTS idx_users_trophies ON users(trophies_total DESC, telegram_id)",
+    """CREATE TABLE IF NOT EXISTS trophy_histogram (
+    trophies INTEGER PRIMARY KEY,
+    users INTEGER NOT NULL
+)""",
+)
+
+AVATAR_SCHEMA = (
+    # photos de profil téléchargées (fichiers dans AVATAR_CACHE_DIR) ; file_unique_id NULL = pas de photo
+    """CREATE TABLE IF NOT EXISTS avatar_cache (
+    telegram_id INTEGER PRIMARY KEY,
+    file_unique_id TEXT,
+    etag TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    fetched_at REAL NOT NULL,
+    checked_at REAL NOT NULL,
+    last_access REAL NOT NULL
+)""",
+    "CREATE INDEX IF NOT EXISTS idx_avatar_cache_last_access ON avatar_cache(last_access)",
+)
+
+# Migrations versionnées (python main.py migrate) : MIGRATIONS[n-1] fait passer le schéma
+# de la version n-1 à n, dans une seule transaction. Version courante : PRAGMA user_version
+# (SQLite) ou table schema_version (PostgreSQL). Une base antérieure au versionnement
+# (version 0) repasse par la migration 1, idempotente (IF NOT EXISTS).
+def migration_1(cx):
+    # schéma initial + remplissage des tables dérivées sur une base existante
+    if DB_IS_PG:
+        # mêmes tables que init_sqlite_schema, types PostgreSQL
+        for ddl in PG_SCHEMA:
+            cx.execute(ddl)
+    else:
+        init_sqlite_schema(cx)
+        for ddl in AVATAR_SCHEMA:
+            cx.execute(ddl)
+    if (cx.execute("SELECT 1 FROM trophy_histogram LIMIT 1").fetchone() is None
+            and cx.execute("SELECT 1 FROM users LIMIT 1").fetchone()):
+        rebuild_trophy_histogram(cx)
+    if (cx.execute("SELECT 1 FROM referral_counts LIMIT 1").fetchone() is None
+            and cx.execute("SELECT 1 FROM users WHERE referral_code_used IS NOT NULL LIMIT 1").fetchone()):
+        rebuild_referral_counts(cx)
+
+def migration_2(cx):
+    # échecs TonAPI par wallet (adresse invalide, panne) : prochain essai avec backoff
+    cx.execute("""CREATE TABLE IF NOT EXISTS nft_failures (
+    wallet_address TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    retry_at BIGINT NOT NULL
+)""")
+
+MIGRATIONS = [migration_1, migration_2]
+MIGRATION_LOCK_ID = 720_501   # verrou consultatif PostgreSQL : un seul migrateur à la fois
+REFERRAL_LOCK_ID = 720_502    # un seul changement de l’arbre de parrainage à la fois
+
+def lock_referrals():
+    # PostgreSQL (READ COMMITTED) : les compteurs sont calculés depuis la chaîne et le sous-arbre
+    # lus juste avant ; deux changements simultanés les feraient dériver. SQLite : BEGIN IMMEDIATE.
+    if DB_IS_PG:
+        db().execute("SELECT pg_advisory_xact_lock(?)", (REFERRAL_LOCK_ID,))
+
+def migrate() -> tuple[int, int]:
+    # → (version avant, version après)
+    cx = db()
+    if DB_IS_PG:
+        cx.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    with tx():
+        if DB_IS_PG:
+            cx.execute("SELECT pg_advisory_xact_lock(?)", (MIGRATION_LOCK_ID,))
+            row = cx.execute("SELECT version FROM schema_version").fetchone()
+            current = row[0] if row else 0
+        else:
+            current = cx.execute("PRAGMA user_version").fetchone()[0]
+        for step in MIGRATIONS[current:]:
+            step(cx)
+        target = max(current, len(MIGRATIONS))
+        if target != current:
+            if DB_IS_PG:
+                cx.execute("DELETE FROM schema_version")
+                cx.execute("INSERT INTO schema_version (version) VALUES (?)", (target,))
+            else:
+                cx.execute(f"PRAGMA user_version={target}")
+    return current, target
+
+def rebuild_derived_tables() -> int:
+    # python main.py rebuild : après un import direct dans users (ex: bench/seed.py)
+    cx = db()
+    with tx():
+        lock_referrals()
+        rebuild_trophy_histogram(cx)
+        rebuild_referral_counts(cx)
+    return cx.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+def rebuild_trophy_histogram(cx):
+    # recalcul complet ; ensuite tenu à jour de façon incrémentale
+    cx.execute("DELETE FROM trophy_histogram")
+    cx.execute("""INSERT INTO trophy_histogram (trophies, users)
+                  SELECT COALESCE(trophies_total, 0), COUNT(*) FROM users GROUP BY COALESCE(trophies_total, 0)""")
+
+def rebuild_referral_counts(cx):
+    # recalcul complet (base existante) ; ensuite tenu à jour de façon incrémentale
+    cx.execute("DELETE FROM referral_counts")
+    cx.execute("""
+WITH RECURSIVE chain(ancestor, descendant, depth) AS (
+    SELECT p.telegram_id, u.telegram_id, 1
+    FROM users u JOIN users p ON p.personal_code = u.referral_code_used
+    UNION ALL
+    SELECT p.telegram_id, ch.descendant, ch.depth + 1
+    FROM chain ch
+    JOIN users a ON a.telegram_id = ch.ancestor
+    JOIN users p ON p.personal_code = a.referral_code_used
+    WHERE ch.depth < ?
+)
+INSERT INTO referral_counts (telegram_id, depth, invited)
+SELECT ancestor, depth, COUNT(*) FROM chain GROUP BY ancestor, depth
+""", (REFERRAL_MAX_DEPTH,))
 
 def generate_referral_code(length=6):
     import random, string
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
-def is_user_registered(uid:int) -> bool:
-    c.execute("SELECT 1 FROM users WHERE telegram_id=?", (uid,))
-    return c.fetchone() is not None
+USER_COLUMNS = """telegram_id, username, wallet_address, personal_code,
+                  referral_code_used, trophies_total, hat, jacket, pants,
+                  shoes, bracelet, profile_photo_path"""
 
 def get_user(uid:int):
-    c.execute("""SELECT telegram_id, username, wallet_address, personal_code,
-                        referral_code_used, trophies_total, hat, jacket, pants,
-                        shoes, bracelet, profile_photo_path
-                 FROM users WHERE telegram_id=?""", (uid,))
-    return c.fetchone()
+    return overlay_user(db().execute(f"SELECT {USER_COLUMNS} FROM users WHERE telegram_id=?", (uid,)).fetchone())
+
+def get_user_view(uid:int):
+    # tout ce qu’affiche /api/me en une requête : ligne users + username du parrain + NFT en cache
+    return overlay_user(db().execute("""SELECT u.telegram_id, u.username, u.wallet_address, u.personal_code,
+                                  u.referral_code_used, u.trophies_total, u.hat, u.jacket, u.pants,
+                                  u.shoes, u.bracelet, u.profile_photo_path, p.username, n.items
+                           FROM users u
+                           LEFT JOIN users p ON p.personal_code = u.referral_code_used
+                           LEFT JOIN nft_cache n ON n.wallet_address = u.wallet_address
+                           WHERE u.telegram_id=?""", (uid,)).fetchone())
 
 def upsert_user(uid:int, username:str=None):
+    # renvoie la ligne (comme get_user) : utilisateur connu et inchangé → une seule lecture,
+    # sinon un seul INSERT ... ON CONFLICT ... RETURNING
     row = get_user(uid)
-    if row:
-        if username and username != row[1]:
-            c.execute("UPDATE users SET username=? WHERE telegram_id=?", (username, uid))
-            conn.commit()
-        return
+    if row and (not username or username == row[1]):
+        return row
+    if row and buffer_user_write(uid, username=username):
+        return row[:1] + (username,) + row[2:]
     # create new user with a personal_code (parrainage)
     pc = generate_referral_code()
-    c.execute("INSERT INTO users (telegram_id, username, personal_code) VALUES (?, ?, ?)", (uid, username, pc))
-    conn.commit()
+    discard_user_writes(uid, "username")
+    with tx():
+        row = db().execute(f"""INSERT INTO users (telegram_id, username, personal_code) VALUES (?, ?, ?)
+                               ON CONFLICT(telegram_id) DO UPDATE SET username=COALESCE(excluded.username, users.username)
+                               RETURNING {USER_COLUMNS}""", (uid, username, pc)).fetchone()
+        if row[3] == pc:
+            histogram_add(0, +1)
+    return row
 
-def set_referral_if_empty(uid:int, code:str):
+def set_referral_if_empty(uid:int, code:str, me=None) -> bool:
+    # me = ligne get_user/upsert_user de uid si l’appelant l’a déjà ; True si le parrainage a été posé
     if not code:
+        return False
+    if me is None:
+        me = get_user(uid)
+    # ne pas se parrainer soi-même ; si déjà renseigné, on ne change pas
+    if not me or me[3] == code or me[4]:
+        return False
+    with tx():
+        lock_referrals()
+        # vérifier que le code existe
+        inv = db().execute("SELECT telegram_id FROM users WHERE personal_code=?", (code,)).fetchone()
+        if not inv:
+            return False
+        # pas de boucle : le filleul ne doit pas être au-dessus de son parrain
+        chain = [inv[0]] + referral_ancestors(inv[0], REFERRAL_MAX_DEPTH - 1)
+        if uid in chain:
+            return False
+        cur = db().execute("UPDATE users SET referral_code_used=? WHERE telegram_id=? AND referral_code_used IS NULL",
+                           (code, uid))
+        if cur.rowcount == 0:
+            return False
+        apply_referral_delta(uid, chain, +1)
+    after_commit(invalidate_me, uid)
+    return True
+
+def referral_ancestors(uid:int, levels:int) -> list[int]:
+    # [parrain, parrain du parrain, ...] sur au plus `levels` niveaux, en une requête récursive
+    rows = db().execute("""
+WITH RECURSIVE chain(id, depth) AS (
+    SELECT CAST(? AS BIGINT), 0
+    UNION ALL
+    SELECT p.telegram_id, ch.depth + 1
+    FROM chain ch
+    JOIN users u ON u.telegram_id = ch.id
+    JOIN users p ON p.personal_code = u.referral_code_used
+    WHERE ch.depth < ?
+)
+SELECT id FROM chain WHERE depth > 0 ORDER BY depth""", (uid, levels)).fetchall()
+    out = []
+    for (ancestor,) in rows:
+        if ancestor == uid or ancestor in out:
+            break
+        out.append(ancestor)
+    return out
+
+def apply_referral_delta(uid:int, ancestors:list[int], sign:int):
+    # uid (profondeur 0) et ses filleuls par niveau remontent vers chaque ancêtre, décalés de sa distance
+    subtree = {0: 1}
+    subtree.update(db().execute("SELECT depth, invited FROM referral_counts WHERE telegram_id=?", (uid,)).fetchall())
+    rows = []
+    for dist, ancestor in enumerate(ancestors, start=1):
+        for depth, n in subtree.items():
+            if dist + depth <= REFERRAL_MAX_DEPTH:
+                rows.append((ancestor, dist + depth, sign * n))
+    db().executemany("""INSERT INTO referral_counts (telegram_id, depth, invited) VALUES (?, ?, ?)
+                        ON CONFLICT(telegram_id, depth) DO UPDATE SET invited = referral_counts.invited + excluded.invited""", rows)
+    if sign < 0:
+        db().executemany("DELETE FROM referral_counts WHERE telegram_id=? AND depth=? AND invited <= 0",
+                         [(a, d) for a, d, _ in rows])
+
+def delete_user(uid:int):
+    discard_user_writes(uid)
+    with tx():
+        lock_referrals()
+        # retire d’abord le sous-arbre de uid des compteurs de ses parrains
+        apply_referral_delta(uid, referral_ancestors(uid, REFERRAL_MAX_DEPTH), -1)
+        db().execute("DELETE FROM referral_counts WHERE telegram_id=?", (uid,))
+        row = db().execute("DELETE FROM users WHERE telegram_id=? RETURNING trophies_total", (uid,)).fetchone()
+        if row:
+            histogram_add(row[0] or 0, -1)
+            after_commit(leaderboard_touch, row[0] or 0, row[0] or 0)
+        after_commit(invalidate_me, uid)
+
+def referral_stats(uid:int) -> dict:
+    levels = dict(db().execute("SELECT depth, invited FROM referral_counts WHERE telegram_id=?", (uid,)).fetchall())
+    return {
+        "direct": levels.get(1, 0),
+        "levels": {str(d): levels.get(d, 0) for d in range(1, REFERRAL_MAX_DEPTH + 1)},
+        "total": sum(levels.values()),
+    }
+
+def top_referrers(limit:int=10) -> list[dict]:
+    rows = db().execute("""SELECT r.telegram_id, u.username, r.invited
+                           FROM referral_counts r JOIN users u ON u.telegram_id = r.telegram_id
+                           WHERE r.depth = 1 ORDER BY r.invited DESC LIMIT ?""", (limit,)).fetchall()
+    return [{"telegram_id": t, "username": u, "invited": n} for t, u, n in rows]
+
+def set_wallet(uid:int, address:str):
+    if buffer_user_write(uid, wallet_address=address):
+        invalidate_me(uid)
         return
-    # ne pas se parrainer soi-même
-    c.execute("SELECT personal_code FROM users WHERE telegram_id=?", (uid,))
-    me = c.fetchone()
-    if me and me[0] == code:
-        return
-    # si déjà renseigné, on ne change pas
-    c.execute("SELECT referral_code_used FROM users WHERE telegram_id=?", (uid,))
-    cur = c.fetchone()
-    if cur and cur[0]:
+    discard_user_writes(uid, "wallet_address")
+    with tx():
+        db().execute("UPDATE users SET wallet_address=? WHERE telegram_id=?", (address, uid))
+        after_commit(invalidate_me, uid)
+
+def update_trophies(uid:int, total:int, old:int|None=None):
+    # old = trophies_total déjà lu par l’appelant (évite la relecture) ; l’UPDATE est conditionnel
+    if old is not None and old == total:
         return
-    # vérifier que le code existe
-    c.execute("SELECT telegram_id FROM users WHERE personal_code=?", (code,))
-    inv = c.fetchone()
-    if not inv:
+    if buffer_user_write(uid, trophies_total=total):
         return
-    c.execute("UPDATE users SET referral_code_used=? WHERE telegram_id=?", (code, uid))
-    conn.commit()
+    if discard_user_writes(uid, "trophies_total"):
+        old = None    # old lu avec la valeur en attente : relire celle de la base
+    with tx():
+        if old is None:
+            row = db().execute("SELECT trophies_total FROM users WHERE telegram_id=?", (uid,)).fetchone()
+            if not row:
+                return
+            old = row[0]
+        if old == total:
+            return
+        cur = db().execute("UPDATE users SET trophies_total=? WHERE telegram_id=? AND COALESCE(trophies_total, 0)=?",
+                           (total, uid, old or 0))
+        if cur.rowcount == 0:
+            return
+        histogram_add(old or 0, -1)
+        histogram_add(total, +1)
+        after_commit(leaderboard_touch, old or 0, total)
 
-def set_wallet(uid:int, address:str):
-    c.execute("UPDATE users SET wallet_address=? WHERE telegram_id=?", (address, uid))
-    conn.commit()
+def update_trophies_many(totals:dict[int, int], deltas:dict[int, int]|None=None,
+                         discard_pending:bool=True) -> dict[int, int]:
+    # écriture groupée (une transaction) : nouveau total = totals[uid] (ou l’actuel) + deltas[uid] ;
+    # renvoie {uid: total final} pour les utilisateurs connus. Un total différé plus ancien
+    # (write-behind) est écarté, sauf quand c’est flush_user_writes qui l’écrit.
+    deltas = deltas or {}
+    ids = sorted(totals.keys() | deltas.keys())   # verrous pris dans le même ordre partout
+    if not ids:
+        return {}
+    # un delta s’applique au total différé s’il y en a un (plus récent que la base)
+    base = pop_pending_field(ids, "trophies_total") if discard_pending else {}
+    with tx() as cx:
+        old = {}
+        for i in range(0, len(ids), 500):
+            part = ids[i:i + 500]
+            old.update(cx.execute(f"""SELECT telegram_id, trophies_total FROM users WHERE telegram_id IN ({','.join('?' * len(part))})
+                                      ORDER BY telegram_id{SQL_FOR_UPDATE}""", part).fetchall())
+        final = {uid: max(0, totals.get(uid, base.get(uid, old[uid] or 0)) + deltas.get(uid, 0)) for uid in ids if uid in old}
+        changed = [(total, uid) for uid, total in final.items() if old[uid] != total]
+        cx.executemany("UPDATE users SET trophies_total=? WHERE telegram_id=?", changed)
+        delta = Counter()
+        for total, uid in changed:
+            delta[old[uid] or 0] -= 1
+            delta[total] += 1
+        cx.executemany("""INSERT INTO trophy_histogram (trophies, users) VALUES (?, ?)
+                          ON CONFLICT(trophies) DO UPDATE SET users = trophy_histogram.users + excluded.users""",
+                       [(t, n) for t, n in delta.items() if n])
+        cx.executemany("DELETE FROM trophy_histogram WHERE trophies=? AND users <= 0",
+                       [(t,) for t, n in delta.items() if n < 0])
+        for total, uid in changed:
+            after_commit(leaderboard_touch, old[uid] or 0, total)
+            after_commit(invalidate_me, uid)
+    return final
 
-def update_trophies(uid:int, total:int):
-    c.execute("UPDATE users SET trophies_total=? WHERE telegram_id=?", (total, uid))
-    conn.commit()
+def existing_user_ids(ids) -> set[int]:
+    # telegram_id présents dans users, par paquets de 500
+    ids, found = list(ids), set()
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        found.update(r[0] for r in db().execute(
+            f"SELECT telegram_id FROM users WHERE telegram_id IN ({','.join('?' * len(part))})", part).fetchall())
+    return found
 
-def inviter_username_from_code(code:str):
-    if not code:
-        return None
-    c.execute("SELECT username FROM users WHERE personal_code=?", (code,))
-    row = c.fetchone()
-    return row[0] if row and row[0] else None
+def histogram_add(trophies:int, n:int):
+    db().execute("""INSERT INTO trophy_histogram (trophies, users) VALUES (?, ?)
+                    ON CONFLICT(trophies) DO UPDATE SET users = trophy_histogram.users + excluded.users""", (trophies, n))
+    if n < 0:
+        db().execute("DELETE FROM trophy_histogram WHERE trophies=? AND users <= 0", (trophies,))
+
+def trophy_rank(trophies:int) -> int:
+    # 1 + nb d’utilisateurs strictement devant : parcourt les paliers distincts, pas les utilisateurs
+    above = db().execute("SELECT COALESCE(SUM(users), 0) FROM trophy_histogram WHERE trophies > ?",
+                         (trophies,)).fetchone()[0]
+    return above + 1
 
 # =========================
-# Bot2: récupération trophées
+# Écritures différées (write-behind, WRITE_BEHIND_INTERVAL > 0)
 # =========================
-def get_pioches_from_bot2(telegram_id:int) -> int:
-    if not BOT2_URL or not API_SECRET:
+# Les écritures de profil isolées (avatar, wallet, trophées, username) sont fusionnées
+# par utilisateur et par colonne en mémoire, puis écrites en une transaction toutes les
+# WRITE_BEHIND_INTERVAL secondes ou dès WRITE_BEHIND_MAX utilisateurs en attente :
+# au plus cette fenêtre est perdue en cas d’arrêt brutal. get_user / get_user_view
+# renvoient les valeurs en attente ; les lectures SQL directes (dashboard, classement)
+# les voient après écriture. Une écriture faite dans la transaction d’un appelant
+# (ex: /ton/submit) reste immédiate et remplace les valeurs en attente des mêmes colonnes.
+USER_FIELDS = tuple(c.strip() for c in USER_COLUMNS.split(","))
+
+_pending_writes: dict[int, dict] = {}   # uid -> {colonne: valeur}
+_flushing_writes: dict[int, dict] = {}  # en cours d’écriture : encore visibles jusqu’au COMMIT
+_pending_lock = Lock()
+write_behind_wakeup = Event()
+
+def buffer_user_write(uid:int, **fields) -> bool:
+    # False = à écrire tout de suite (write-behind désactivé ou transaction de l’appelant ouverte)
+    if WRITE_BEHIND_INTERVAL <= 0 or getattr(_db_local, "tx_depth", 0):
+        return False
+    with _pending_lock:
+        _pending_writes.setdefault(uid, {}).update(fields)
+        size = len(_pending_writes)
+    if size >= WRITE_BEHIND_MAX:
+        write_behind_wakeup.set()
+    return True
+
+def discard_user_writes(uid:int, *fields) -> bool:
+    # retire les valeurs en attente (toutes, ou ces colonnes) ; True s’il y en avait
+    if WRITE_BEHIND_INTERVAL <= 0:
+        return False
+    found = False
+    with _pending_lock:
+        for pending in (_pending_writes, _flushing_writes):
+            entry = pending.get(uid)
+            if entry is None:
+                continue
+            for col in fields or list(entry):
+                found = entry.pop(col, None) is not None or found
+            if not entry:
+                del pending[uid]
+    return found
+
+def pop_pending_field(ids, col:str) -> dict:
+    # retire col des valeurs en attente pour ces uid ; → {uid: dernière valeur en attente}
+    if WRITE_BEHIND_INTERVAL <= 0:
+        return {}
+    out = {}
+    with _pending_lock:
+        for pending in (_flushing_writes, _pending_writes):   # la plus récente l’emporte
+            for uid in ids:
+                entry = pending.get(uid)
+                if entry and col in entry:
+                    out[uid] = entry.pop(col)
+                    if not entry:
+                        del pending[uid]
+    return out
+
+def overlay_user(row):
+    # ligne get_user / get_user_view + valeurs en attente pour cet utilisateur
+    if row is None or WRITE_BEHIND_INTERVAL <= 0:
+        return row
+    with _pending_lock:
+        if row[0] not in _pending_writes and row[0] not in _flushing_writes:
+            return row
+        fields = {**_flushing_writes.get(row[0], {}), **_pending_writes.get(row[0], {})}
+    out = list(row)
+    for col, value in fields.items():
+        out[USER_FIELDS.index(col)] = value
+    if "wallet_address" in fields and len(out) > len(USER_FIELDS):
+        out[-1] = None   # get_user_view : nft_cache joint sur l’ancien wallet, relu par get_cached_nfts
+    return tuple(out)
+
+def flush_user_writes() -> int:
+    global _pending_writes, _flushing_writes
+    with _pending_lock:
+        pending, _pending_writes = _pending_writes, {}
+        _flushing_writes = pending
+    if not pending:
         return 0
     try:
-        r = requests.get(BOT2_URL, params={"telegram_id": telegram_id, "secret": API_SECRET}, timeout=6)
+        with tx() as cx:
+            # copie prise sous le verrou, une fois le verrou d’écriture DB obtenu :
+            # discard_user_writes modifie `pending` depuis d’autres threads
+            with _pending_lock:
+                snapshot = {uid: dict(fields) for uid, fields in pending.items()}
+            groups = {}
+            for uid, fields in snapshot.items():
+                cols = tuple(sorted(c for c in fields if c != "trophies_total"))
+                if cols:
+                    groups.setdefault(cols, []).append(tuple(fields[c] for c in cols) + (uid,))
+            for cols, rows in groups.items():
+                cx.executemany(f"UPDATE users SET {', '.join(c + '=?' for c in cols)} WHERE telegram_id=?", rows)
+            # trophées : histogramme et classement tenus à jour par update_trophies_many
+            update_trophies_many({uid: f["trophies_total"] for uid, f in snapshot.items() if "trophies_total" in f},
+                                 discard_pending=False)
+    except Exception:
+        # remis en attente sous les écritures arrivées entre-temps (plus récentes)
+        with _pending_lock:
+            newer, _pending_writes = _pending_writes, pending
+            for uid, fields in newer.items():
+                _pending_writes.setdefault(uid, {}).update(fields)
+            _flushing_writes = {}
+        raise
+    with _pending_lock:
+        _flushing_writes = {}
+    return len(pending)
+
+def write_behind_worker():
+    while True:
+        write_behind_wakeup.wait(timeout=WRITE_BEHIND_INTERVAL)
+        write_behind_wakeup.clear()
+        try:
+            flush_user_writes()
+        except Exception as e:
+            print("write_behind_worker error:", e)
+
+# =========================
+# Boucle asyncio partagée + clients httpx amont
+# =========================
+# Tous les appels amont (Bot2, TonAPI, Bot API) passent par des httpx.AsyncClient
+# poolés qui vivent sur une seule boucle : un thread démon en mode "thread",
+# la boucle du serveur (partagée avec le bot) en mode "asgi".
+io_loop: asyncio.AbstractEventLoop | None = None
+_io_loop_pid = None
+_io_lock = Lock()
+_http_clients: dict[str, httpx.AsyncClient] = {}
+
+def ensure_io_loop() -> asyncio.AbstractEventLoop:
+    global io_loop, _io_loop_pid
+    with _io_lock:
+        # après un fork (gunicorn --preload), le thread de la boucle du parent n’existe plus
+        if io_loop is None or io_loop.is_closed() or (_io_loop_pid not in (None, os.getpid())):
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, daemon=True, name="io-loop").start()
+            io_loop, _io_loop_pid = loop, os.getpid()
+            _http_clients.clear()
+    return io_loop
+
+def run_io(coro, timeout:float|None=None):
+    # exécute une coroutine amont depuis du code synchrone (routes Flask, workers)
+    return asyncio.run_coroutine_threadsafe(coro, ensure_io_loop()).result(timeout)
+
+# Réglages par amont, surchargeables par env : <NOM>_TIMEOUT, <NOM>_RETRIES,
+# <NOM>_MAX_CONNECTIONS, <NOM>_MAX_KEEPALIVE (ex: TONAPI_TIMEOUT=5)
+class UpstreamConfig:
+    def __init__(self, name:str, timeout:float, retries:int):
+        env = name.upper()
+        self.name = name
+        self.timeout = float(os.getenv(f"{env}_TIMEOUT", str(timeout)))
+        self.retries = int(os.getenv(f"{env}_RETRIES", str(retries)))
+        self.max_connections = int(os.getenv(f"{env}_MAX_CONNECTIONS", str(HTTP_MAX_CONNECTIONS)))
+        self.max_keepalive = int(os.getenv(f"{env}_MAX_KEEPALIVE", str(HTTP_MAX_KEEPALIVE)))
+
+UPSTREAMS = {
+    "bot2":     UpstreamConfig("bot2", timeout=6, retries=1),
+    "tonapi":   UpstreamConfig("tonapi", timeout=8, retries=1),
+    "telegram": UpstreamConfig("telegram", timeout=6, retries=1),
+}
+RETRY_STATUSES = {502, 503, 504}
+
+def http_client(name:str) -> httpx.AsyncClient:
+    # à appeler depuis io_loop : un client (et donc un pool keep-alive) par amont
+    client = _http_clients.get(name)
+    if client is None:
+        conf = UPSTREAMS[name]
+        client = httpx.AsyncClient(
+            timeout=conf.timeout,
+            limits=httpx.Limits(max_connections=conf.max_connections,
+                                max_keepalive_connections=conf.max_keepalive,
+                                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        )
+        _http_clients[name] = client
+    return client
+
+async def upstream_request(name:str, method:str, url:str, **kwargs) -> httpx.Response:
+    # GET : nouvel essai sur erreur réseau ou 502/503/504 ; autres méthodes : seulement si
+    # la connexion n’a pas pu s’établir (la requête n’est pas partie)
+    conf = UPSTREAMS[name]
+    client = http_client(name)
+    attempt = 0
+    while True:
+        t0 = time.perf_counter()
+        try:
+            r = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            upstream_latency.observe(time.perf_counter() - t0, name)
+            upstream_errors.inc(name)
+            retryable = method == "GET" or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+            if not retryable or attempt >= conf.retries:
+                raise
+        else:
+            failed = r.status_code >= 500
+            upstream_latency.observe(time.perf_counter() - t0, name)
+            if failed:
+                upstream_errors.inc(name)
+            if method != "GET" or r.status_code not in RETRY_STATUSES or attempt >= conf.retries:
+                return r
+        attempt += 1
+        upstream_retries.inc(name)
+        await asyncio.sleep(0.2 * 2 ** attempt)
+
+async def close_http_clients():
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    for client in clients:
+        await client.aclose()
+
+async def tg_api(method:str, **params) -> dict:
+    r = await upstream_request("telegram", "POST", f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/{method}",
+                               json=params)
+    return r.json()
+
+def upstream_stats_snapshot() -> dict:
+    # résumé JSON des métriques Prometheus upstream_* (même source que /metrics)
+    out = {}
+    for name in UPSTREAMS:
+        calls, total_s = upstream_latency.totals(name)
+        out[name] = {
+            "calls": calls, "errors": int(upstream_errors.value(name)),
+            "retries": int(upstream_retries.value(name)),
+            "avg_ms": round(total_s * 1000 / calls, 1) if calls else 0.0,
+        }
+    return out
+
+# =========================
+# Appels amont en parallèle (Bot2, Bot API)
+# =========================
+upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix="upstream")
+
+def fan_out(calls:dict, deadline:float, defaults:dict):
+    # lance chaque appel dans le pool, attend au plus `deadline` secondes au total
+    # → (résultats, liste des sources expirées) ; une source en échec/expirée prend sa valeur par défaut
+    futures = {name: upstream_pool.submit(fn, *args) for name, (fn, *args) in calls.items()}
+    wait(futures.values(), timeout=deadline)
+    results, timed_out = {}, []
+    for name, fut in futures.items():
+        if fut.done() and not fut.exception():
+            results[name] = fut.result()
+        else:
+            if not fut.done():
+                timed_out.append(name)
+                fut.cancel()
+            results[name] = defaults.get(name)
+    return results, timed_out
+
+# =========================
+# Cache mémoire : TTL + stale-while-revalidate + LRU
+# =========================
+# pool séparé de upstream_pool : un appel en cours dans upstream_pool peut attendre un chargement
+refresh_pool = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="refresh")
+
+class SWRCache:
+    # loader(key) → valeur, ou None si l’amont a échoué (on garde alors l’ancienne valeur).
+    # Entrée fraîche → servie telle quelle ; périmée (ttl < âge < ttl+stale_ttl) → servie
+    # et rafraîchie en tâche de fond ; absente → chargée. Un seul chargement en vol par clé.
+    # inline=True : une entrée absente est chargée par le premier appelant lui-même (pas
+    # d’attente derrière les tâches du pool), les appelants suivants attendent son Future.
+    def __init__(self, loader, ttl:float, stale_ttl:float=0.0, max_size:int=10000, executor=None,
+                 name:str="", inline:bool=False):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.executor = executor or refresh_pool
+        self.inline = inline
+        self._data = OrderedDict()   # key -> (valeur, horodatage)
+        self._inflight = {}          # key -> Future ; retiré par invalidate() : ce chargement ne sera pas stocké
+        self._lock = Lock()
+
+    def get(self, key, seed=None, timeout:float|None=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, ts = entry
+                if now - ts < self.ttl:
+                    self._data.move_to_end(key)
+                    cache_requests.inc(self.name, "hit")
+                    return value
+                if now - ts < self.ttl + self.stale_ttl:
+                    self._data.move_to_end(key)
+                    cache_requests.inc(self.name, "stale")
+                    self._refresh_locked(key)
+                    return value
+            cache_requests.inc(self.name, "miss")
+            if seed is not None:
+                # valeur connue ailleurs (ex: DB) : servie tout de suite, marquée périmée
+                self._store_locked(key, seed, now - self.ttl)
+                self._refresh_locked(key)
+                return seed
+            fut = self._inflight.get(key)
+            owner = fut is None and self.inline
+            if owner:
+                fut = self._inflight[key] = Future()
+            else:
+                fut = self._refresh_locked(key)
+        if owner:
+            self._load(key, fut)
+        try:
+            value = fut.result(timeout=timeout)
+        except Exception:
+            value = None
+        if value is None and entry is not None:
+            return entry[0]
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store_locked(key, value, time.monotonic())
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._inflight.pop(key, None)
+
+    def _store_locked(self, key, value, ts):
+        self._data[key] = (value, ts)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def _refresh_locked(self, key) -> Future:
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = Future()
+            self._inflight[key] = fut
+            self.executor.submit(self._load, key, fut)
+        return fut
+
+    def _load(self, key, fut:Future):
+        try:
+            value = self.loader(key)
+        except Exception:
+            value = None
+        with self._lock:
+            # fut n’est plus le chargement en vol de key : invalidé pendant le chargement
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+                if value is not None:
+                    self._store_locked(key, value, time.monotonic())
+        fut.set_result(value)
+
+# seau à jetons (débit moyen `rate`/s, rafale `burst`) ; non thread-safe, un par consommateur
+class TokenBucket:
+    def __init__(self, rate:float, burst:float=1.0):
+        self.rate = rate
+        self.capacity = max(burst, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0   # monotonic
+
+    def pause(self, seconds:float):
+        # plus aucun jeton avant `seconds` (429 : retry_after imposé par l’amont)
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    def paused_for(self) -> float:
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def take(self) -> float:
+        # 0 si un jeton a été pris, sinon le temps d’attente avant le prochain
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.updated = max(self.updated, self.paused_until)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+# =========================
+# Bot2: récupération trophées
+# =========================
+async def fetch_pioches_from_bot2_async(telegram_id:int) -> int | None:
+    try:
+        r = await upstream_request("bot2", "GET", BOT2_URL,
+                                   params={"telegram_id": telegram_id, "secret": API_SECRET})
         if r.status_code == 200:
             data = r.json()
             return int(data.get("total_pioches", 0))
+    except httpx.TransportError:
+        pass    # déjà compté par upstream_request
     except Exception:
-        pass
-    return 0
+        upstream_errors.inc("bot2")    # réponse illisible
+    return None
+
+def fetch_pioches_from_bot2(telegram_id:int) -> int | None:
+    return run_io(fetch_pioches_from_bot2_async(telegram_id))
+
+# un appel Bot2 au plus par utilisateur et par BOT2_CACHE_TTL ; en cas de panne, l’ancienne valeur reste servie
+trophy_cache = SWRCache(fetch_pioches_from_bot2, BOT2_CACHE_TTL, BOT2_CACHE_STALE, BOT2_CACHE_MAX, name="bot2")
+
+def get_sync_state(name:str) -> str | None:
+    row = db().execute("SELECT value FROM sync_state WHERE name=?", (name,)).fetchone()
+    return row[0] if row else None
+
+def set_sync_state(name:str, value:str):
+    db().execute("""INSERT INTO sync_state (name, value, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at""",
+                 (name, value, time.time()))
+    db().commit()
+
+def get_pioches_from_bot2(telegram_id:int, seed:int|None=None) -> int:
+    # seed = users.trophies_total : renvoyé immédiatement si le cache est vide, Bot2 est rafraîchi en fond
+    if not BOT2_URL or not API_SECRET:
+        return seed if seed is not None else 0
+    total = trophy_cache.get(telegram_id, seed=seed, timeout=6)
+    if total is None:
+        return seed if seed is not None else 0
+    return total
+
+# Synchro groupée : parcourt users par paquets (reprise au dernier telegram_id traité),
+# un appel Bot2 par paquet via BOT2_BULK_URL, sinon appels unitaires en concurrence bornée.
+_bulk_unsupported = False
+
+async def _pace(bucket:TokenBucket):
+    while (wait_s := bucket.take()):
+        await asyncio.sleep(wait_s)
+
+async def fetch_pioches_bulk(ids:list[int], bucket:TokenBucket) -> dict[int, int]:
+    global _bulk_unsupported
+    if BOT2_BULK_URL and not _bulk_unsupported:
+        await _pace(bucket)
+        try:
+            r = await upstream_request("bot2", "POST", BOT2_BULK_URL,
+                                       json={"telegram_ids": ids, "secret": API_SECRET})
+            if r.status_code == 200:
+                totals = r.json().get("totals") or {}
+                return {int(k): int(v) for k, v in totals.items()}
+            if r.status_code in (404, 405, 501):
+                _bulk_unsupported = True
+        except httpx.TransportError:
+            pass    # déjà compté par upstream_request
+        except Exception:
+            upstream_errors.inc("bot2")    # réponse illisible
+    sem = asyncio.Semaphore(TROPHY_SYNC_CONCURRENCY)
+    async def one(uid:int):
+        async with sem:
+            await _pace(bucket)
+            return uid, await fetch_pioches_from_bot2_async(uid)
+    results = await asyncio.gather(*(one(uid) for uid in ids))
+    return {uid: total for uid, total in results if total is not None}
+
+def trophy_sync_pass():
+    bucket = TokenBucket(TROPHY_SYNC_RPS, TROPHY_SYNC_RPS)
+    after = int(get_sync_state("trophy_sync.after") or 0)
+    while True:
+        ids = [r[0] for r in db().execute("SELECT telegram_id FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?",
+                                          (after, TROPHY_SYNC_CHUNK)).fetchall()]
+        if not ids:
+            set_sync_state("trophy_sync.after", "0")
+            return
+        totals = run_io(fetch_pioches_bulk(ids, bucket))
+        update_trophies_many(totals)
+        for uid, total in totals.items():
+            trophy_cache.set(uid, total)
+        after = ids[-1]
+        set_sync_state("trophy_sync.after", str(after))
+
+def trophy_sync_worker():
+    while True:
+        try:
+            trophy_sync_pass()
+        except Exception as e:
+            print("trophy_sync_worker error:", e)
+        time.sleep(TROPHY_SYNC_INTERVAL)
+
+# Push Bot2 → Bot1 (/api/trophies/push) : totaux ou deltas fusionnés par uid en mémoire,
+# puis écrits par paquets (une transaction) toutes les TROPHY_PUSH_FLUSH secondes
+# ou dès TROPHY_PUSH_BATCH utilisateurs en attente.
+_trophy_push = {}            # uid -> [total | None, delta]
+_trophy_push_lock = Lock()
+trophy_push_wakeup = Event()
+
+def _merge_push(pending:dict, uid:int, total:int|None, delta:int):
+    entry = pending.setdefault(uid, [None, 0])
+    if total is not None:
+        entry[0], entry[1] = total, delta    # un total remplace tout ce qui précède
+    else:
+        entry[1] += delta
+
+def push_trophies(items:list[tuple[int, int|None, int]]) -> int:
+    # items = [(uid, total | None, delta)] ; renvoie le nombre d’utilisateurs en attente
+    with _trophy_push_lock:
+        for uid, total, delta in items:
+            _merge_push(_trophy_push, uid, total, delta)
+        size = len(_trophy_push)
+    if size >= TROPHY_PUSH_BATCH:
+        trophy_push_wakeup.set()
+    return size
+
+def flush_trophy_push() -> int:
+    global _trophy_push
+    with _trophy_push_lock:
+        pending, _trophy_push = _trophy_push, {}
+    if not pending:
+        return 0
+    totals = {uid: t for uid, (t, _) in pending.items() if t is not None}
+    deltas = {uid: d for uid, (_, d) in pending.items() if d}
+    try:
+        final = update_trophies_many(totals, deltas)
+    except Exception:
+        # remis en file sous les pushes arrivés entre-temps (qui restent prioritaires)
+        with _trophy_push_lock:
+            newer, _trophy_push = _trophy_push, {}
+            for uid, (t, d) in pending.items():
+                _merge_push(_trophy_push, uid, t, d)
+            for uid, (t, d) in newer.items():
+                _merge_push(_trophy_push, uid, t, d)
+        raise
+    for uid, total in final.items():
+        trophy_cache.set(uid, total)
+    return len(final)
+
+def trophy_push_worker():
+    while True:
+        trophy_push_wakeup.wait(timeout=TROPHY_PUSH_FLUSH)
+        trophy_push_wakeup.clear()
+        try:
+            flush_trophy_push()
+        except Exception as e:
+            print("trophy_push_worker error:", e)
 
 # =========================
 # TonAPI NFTs (optionnel)
 # =========================
-def fetch_nfts_for_wallet(address:str):
+async def fetch_nfts_for_wallet_async(address:str) -> list | None:
+    # None = échec TonAPI (on garde alors le cache existant)
     if not address or not TONAPI_KEY:
         return []
     try:
-        url = f"https://tonapi.io/v2/accounts/{address}/nfts"
+        url = f"{TONAPI_URL}/v2/accounts/{address}/nfts"
         headers = {"Authorization": f"Bearer {TONAPI_KEY}"}
-        r = requests.get(url, headers=headers, timeout=8)
+        r = await upstream_request("tonapi", "GET", url, headers=headers)
         if r.status_code != 200:
-            return []
+            return None
         data = r.json()
         items = data.get("nft_items") or data.get("data") or []
         out = []
@@ -200,54 +1605,363 @@ def fetch_nfts_for_wallet(address:str):
             if image:
                 out.append({"name": name, "image": image})
         return out
+    except httpx.TransportError:
+        return None    # déjà compté par upstream_request
     except Exception:
+        upstream_errors.inc("tonapi")    # réponse illisible
+        return None
+
+def fetch_nfts_for_wallet(address:str) -> list | None:
+    return run_io(fetch_nfts_for_wallet_async(address))
+
+def refresh_nfts(address:str):
+    now = int(time.time())
+    failed = db().execute("SELECT failures, retry_at FROM nft_failures WHERE wallet_address=?", (address,)).fetchone()
+    if failed and failed[1] > now:
+        return    # en backoff après un échec
+    nfts = fetch_nfts_for_wallet(address)
+    try:
+        with tx():
+            if nfts is None:
+                # échec : consigné, sinon le wallet reviendrait en tête à chaque passage
+                failures = (failed[0] if failed else 0) + 1
+                delay = min(NFT_RETRY_MAX, NFT_RETRY_BASE * 2 ** min(failures - 1, 20))
+                db().execute("""INSERT INTO nft_failures (wallet_address, failures, retry_at) VALUES (?, ?, ?)
+                                ON CONFLICT(wallet_address) DO UPDATE SET failures=excluded.failures, retry_at=excluded.retry_at""",
+                             (address, failures, now + delay))
+                return
+            db().execute("""INSERT INTO nft_cache (wallet_address, items, fetched_at) VALUES (?, ?, ?)
+                            ON CONFLICT(wallet_address) DO UPDATE SET items=excluded.items, fetched_at=excluded.fetched_at""",
+                         (address, json.dumps(nfts), now))
+            if failed:
+                db().execute("DELETE FROM nft_failures WHERE wallet_address=?", (address,))
+    except Exception as e:
+        print("refresh_nfts error:", e)
+
+def get_cached_nfts(address:str, items:str|None=None) -> list:
+    # lecture seule : /api/me n’attend jamais TonAPI ; un wallet inconnu est mis en file
+    # items = nft_cache.items déjà lu par l’appelant (jointure), sinon relu ici
+    row = (items,) if items is not None else db().execute("SELECT items FROM nft_cache WHERE wallet_address=?", (address,)).fetchone()
+    if row is None:
+        cache_requests.inc("nft", "miss")
+        request_nft_refresh(address)
         return []
+    cache_requests.inc("nft", "hit")
+    return json.loads(row[0])
+
+# rafraîchissement en tâche de fond : wallets demandés d’abord, puis entrées plus vieilles que NFT_CACHE_TTL
+nft_queue = queue.Queue()
+nft_pending = set()
+nft_pending_lock = Lock()
+
+def request_nft_refresh(address:str):
+    if not address or not TONAPI_KEY:
+        return
+    with nft_pending_lock:
+        if address in nft_pending:
+            return
+        nft_pending.add(address)
+    nft_queue.put(address)
+
+def nft_refresher():
+    while True:
+        deadline = time.monotonic() + NFT_REFRESH_INTERVAL
+        while (left := deadline - time.monotonic()) > 0:
+            try:
+                address = nft_queue.get(timeout=left)
+            except queue.Empty:
+                break
+            with nft_pending_lock:
+                nft_pending.discard(address)
+            refresh_nfts(address)
+        try:
+            # jamais récupérés d’abord (jamais essayés avant ceux en échec), puis les plus anciens ;
+            # les wallets en backoff attendent leur retry_at
+            now = int(time.time())
+            due = db().execute("""SELECT u.wallet_address FROM users u
+                                  LEFT JOIN nft_cache n ON n.wallet_address = u.wallet_address
+                                  LEFT JOIN nft_failures f ON f.wallet_address = u.wallet_address
+                                  WHERE u.wallet_address IS NOT NULL
+                                    AND (n.fetched_at IS NULL OR n.fetched_at < ?)
+                                    AND (f.retry_at IS NULL OR f.retry_at <= ?)
+                                  GROUP BY u.wallet_address, n.fetched_at, f.retry_at
+                                  ORDER BY COALESCE(n.fetched_at, 0), COALESCE(f.retry_at, 0)
+                                  LIMIT ?""",
+                               (now - NFT_CACHE_TTL, now, NFT_REFRESH_BATCH)).fetchall()
+        except Exception:
+            due = []
+        for (address,) in due:
+            refresh_nfts(address)
 
 # =========================
 # Photo de profil Telegram
 # =========================
-def get_profile_photo_url(uid:int) -> str | None:
-    # si déjà en DB → renvoie l’URL directe
-    c.execute("SELECT profile_photo_path FROM users WHERE telegram_id=?", (uid,))
-    row = c.fetchone()
-    if row and row[0]:
-        return f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{row[0]}"
+# Le navigateur ne voit jamais d’URL api.telegram.org (qui contient le token) :
+# /media/avatar/<uid> sert une copie locale, téléchargée une fois, bornée en taille
+# (éviction LRU) et re-vérifiée en tâche de fond quand le file_id Telegram change.
+async def fetch_avatar(uid:int, known_unique_id:str|None=None):
+    # → (file_unique_id, contenu) ; contenu None si la photo n’a pas changé ; None si pas de photo
+    jr = await tg_api("getUserProfilePhotos", user_id=uid, limit=1)
+    photos = (jr.get("result") or {}).get("photos") or []
+    if not photos:
+        return None
+    # plus grande taille de la première photo
+    biggest = photos[0][-1]
+    if biggest.get("file_unique_id") == known_unique_id:
+        return known_unique_id, None
+    rf = await tg_api("getFile", file_id=biggest["file_id"])
+    file_path = (rf.get("result") or {}).get("file_path")
+    if not file_path:
+        return None
+    r = await upstream_request("telegram", "GET", f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_TOKEN}/{file_path}")
+    if r.status_code != 200:
+        return None
+    return biggest.get("file_unique_id"), r.content
+
+def avatar_file(uid:int) -> str:
+    return os.path.join(AVATAR_CACHE_DIR, f"{uid}.jpg")
 
-    # sinon on va chercher via Bot API (prend la première photo)
+def refresh_avatar(uid:int):
+    # télécharge / re-vérifie la photo ; renvoie la ligne avatar_cache à jour (ou None si échec)
+    row = local_db().execute("SELECT file_unique_id FROM avatar_cache WHERE telegram_id=?", (uid,)).fetchone()
+    known = row[0] if row and os.path.exists(avatar_file(uid)) else None
     try:
-        # getUserProfilePhotos
-        r = requests.get(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUserProfilePhotos",
-                         params={"user_id": uid, "limit": 1}, timeout=6)
-        jr = r.json()
-        photos = (jr.get("result") or {}).get("photos") or []
-        if not photos:
-            return None
-        # getFile pour la plus grande taille
-        file_id = photos[0][-1]["file_id"]
-        rf = requests.get(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getFile",
-                          params={"file_id": file_id}, timeout=6).json()
-        file_path = (rf.get("result") or {}).get("file_path")
-        if not file_path:
-            return None
-        # on garde en DB
-        c.execute("UPDATE users SET profile_photo_path=? WHERE telegram_id=?", (file_path, uid))
-        conn.commit()
-        return f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
+        res = run_io(fetch_avatar(uid, known))
+    except httpx.TransportError:
+        return None    # déjà compté par upstream_request
     except Exception:
+        upstream_errors.inc("telegram")    # réponse illisible
         return None
+    now = time.time()
+    if res is None:
+        # pas (ou plus) de photo
+        local_db().execute("""INSERT INTO avatar_cache (telegram_id, file_unique_id, etag, size, fetched_at, checked_at, last_access)
+                        VALUES (?, NULL, NULL, 0, ?, ?, ?)
+                        ON CONFLICT(telegram_id) DO UPDATE SET file_unique_id=NULL, etag=NULL, size=0, checked_at=excluded.checked_at""",
+                     (uid, now, now, now))
+        local_db().commit()
+        try:
+            os.remove(avatar_file(uid))
+        except OSError:
+            pass
+        evict_avatars()
+    elif res[1] is None:
+        local_db().execute("UPDATE avatar_cache SET checked_at=? WHERE telegram_id=?", (now, uid))
+        local_db().commit()
+    else:
+        unique_id, content = res
+        os.makedirs(AVATAR_CACHE_DIR, exist_ok=True)
+        tmp = avatar_file(uid) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, avatar_file(uid))
+        etag = hashlib.sha1(content).hexdigest()[:16]
+        local_db().execute("""INSERT INTO avatar_cache (telegram_id, file_unique_id, etag, size, fetched_at, checked_at, last_access)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(telegram_id) DO UPDATE SET file_unique_id=excluded.file_unique_id, etag=excluded.etag,
+                            size=excluded.size, fetched_at=excluded.fetched_at, checked_at=excluded.checked_at""",
+                     (uid, unique_id, etag, len(content), now, now, now))
+        local_db().commit()
+        evict_avatars()
+    return local_db().execute("SELECT file_unique_id, etag, fetched_at, checked_at, last_access FROM avatar_cache WHERE telegram_id=?",
+                        (uid,)).fetchone()
+
+def evict_avatars():
+    # supprime les photos les moins récemment servies jusqu’à repasser sous AVATAR_CACHE_MAX_BYTES ;
+    # les lignes « pas de photo » expirent après AVATAR_RECHECK (re-vérifiées au prochain accès)
+    local_db().execute("DELETE FROM avatar_cache WHERE size = 0 AND checked_at < ?", (time.time() - AVATAR_RECHECK,))
+    local_db().commit()
+    total = local_db().execute("SELECT COALESCE(SUM(size), 0) FROM avatar_cache").fetchone()[0]
+    while total > AVATAR_CACHE_MAX_BYTES:
+        victims = local_db().execute("""SELECT telegram_id, size FROM avatar_cache WHERE size > 0
+                                  ORDER BY last_access LIMIT 50""").fetchall()
+        if not victims:
+            break
+        evicted = []
+        for uid, size in victims:
+            if total <= AVATAR_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(avatar_file(uid))
+            except OSError:
+                pass
+            total -= size
+            evicted.append((uid,))
+        local_db().executemany("DELETE FROM avatar_cache WHERE telegram_id=?", evicted)
+        local_db().commit()
+
+avatar_pending = set()
+avatar_pending_lock = Lock()
+
+def schedule_avatar_refresh(uid:int):
+    with avatar_pending_lock:
+        if uid in avatar_pending:
+            return
+        avatar_pending.add(uid)
+    def job():
+        try:
+            refresh_avatar(uid)
+        finally:
+            with avatar_pending_lock:
+                avatar_pending.discard(uid)
+    refresh_pool.submit(job)
+
+def get_profile_photo_url(uid:int) -> str | None:
+    # lecture DB seulement ; la première récupération se fait en fond ou au premier GET
+    row = local_db().execute("SELECT file_unique_id, etag FROM avatar_cache WHERE telegram_id=?", (uid,)).fetchone()
+    if row is None:
+        schedule_avatar_refresh(uid)
+        return f"{PUBLIC_BASE_URL}/media/avatar/{uid}"
+    if not row[0]:
+        return None
+    return f"{PUBLIC_BASE_URL}/media/avatar/{uid}?v={row[1]}"
+
+@bp.route("/media/avatar/<int:uid>")
+def media_avatar(uid:int):
+    row = local_db().execute("SELECT file_unique_id, etag, fetched_at, checked_at, last_access FROM avatar_cache WHERE telegram_id=?",
+                       (uid,)).fetchone()
+    if row is None or (row[0] and not os.path.exists(avatar_file(uid))):
+        if row is None and db().execute("SELECT 1 FROM users WHERE telegram_id=?", (uid,)).fetchone() is None:
+            abort(404)    # route publique : pas d’appel Telegram ni de ligne avatar_cache pour un uid inconnu
+        cache_requests.inc("avatar", "miss")
+        row = refresh_avatar(uid)
+    else:
+        cache_requests.inc("avatar", "hit")
+    now = time.time()
+    if row and now - row[3] > AVATAR_RECHECK:
+        schedule_avatar_refresh(uid)
+    if not row or not row[0]:
+        abort(404)
+    unique_id, etag, fetched_at, checked_at, last_access = row
+    if now - last_access > 60:
+        # LRU approximatif : au plus une écriture par minute et par avatar
+        local_db().execute("UPDATE avatar_cache SET last_access=? WHERE telegram_id=?", (now, uid))
+        local_db().commit()
+    return send_file(os.path.abspath(avatar_file(uid)), mimetype="image/jpeg", etag=etag,
+                     last_modified=fetched_at, max_age=AVATAR_MAX_AGE, conditional=True)
 
 # =========================
-# Envoi de message brut (HTTP)
+# Outbox : envoi de messages en tâche de fond (HTTP)
 # =========================
+# Les routes n’attendent plus Telegram : le message est écrit dans la table outbox
+# et un worker l’envoie en respectant les limites de la Bot API (seau à jetons
+# global + par chat), avec reprise sur 429 (retry_after) et backoff exponentiel.
+outbox_wakeup = Event()
+
+def enqueue_message(chat_id:int, text:str, reply_markup:dict|None=None):
+    # dans la transaction de l’appelant s’il y en a une : le message part avec l’écriture qui l’a causé
+    now = time.time()
+    with tx():
+        db().execute("INSERT INTO outbox (chat_id, text, reply_markup, next_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                     (chat_id, text, json.dumps(reply_markup) if reply_markup else None, now, now))
+        after_commit(outbox_wakeup.set)
+
 def send_telegram_message_raw(chat_id:int, text:str, reply_markup:dict|None=None):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    # rend la main immédiatement : l’envoi réel est fait par outbox_worker
+    try:
+        enqueue_message(chat_id, text, reply_markup)
+    except Exception as e:
+        print("send_telegram_message_raw error:", e)
+
+def broadcast_message(text:str, reply_markup:dict|None=None) -> int:
+    # un message par utilisateur inscrit (wallet présent), débit max géré par le worker
+    now = time.time()
+    cur = db().execute("""INSERT INTO outbox (chat_id, text, reply_markup, next_at, created_at)
+                          SELECT telegram_id, ?, ?, ?, ? FROM users WHERE wallet_address IS NOT NULL""",
+                       (text, json.dumps(reply_markup) if reply_markup else None, now, now))
+    db().commit()
+    outbox_wakeup.set()
+    return cur.rowcount
+
+def _retry_after(res:dict) -> float:
+    return float((res.get("parameters") or {}).get("retry_after") or 1)
+
+async def _send_outbox_row(chat_id:int, text:str, reply_markup:str|None) -> dict:
     payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
     if reply_markup:
-        payload["reply_markup"] = json.dumps(reply_markup)
+        payload["reply_markup"] = reply_markup
     try:
-        requests.post(url, json=payload, timeout=6)
+        return await tg_api("sendMessage", **payload)
     except Exception as e:
-        print("send_telegram_message_raw error:", e)
+        return {"ok": False, "error_code": 0, "description": str(e)}
+
+def outbox_worker():
+    global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+    chat_buckets = OrderedDict()   # chat_id -> TokenBucket (LRU borné)
+
+    def pause_on_429(fut):
+        # appelé dès la réponse (thread de io_loop) : les envois suivants du lot attendent aussi
+        if not fut.cancelled() and fut.exception() is None and fut.result().get("error_code") == 429:
+            global_bucket.pause(_retry_after(fut.result()))
+
+    while True:
+        if (paused := global_bucket.paused_for()):
+            # 429 reçu : Telegram bloque tout le bot, rien n’est réservé avant la fin du délai
+            time.sleep(paused)
+        now = time.time()
+        try:
+            # réservation atomique : un autre worker ne reprendra pas ces messages avant OUTBOX_LEASE
+            rows = db().execute(f"""UPDATE outbox SET next_at=?
+                                   WHERE id IN (SELECT id FROM outbox WHERE next_at<=? ORDER BY next_at, id LIMIT ?{SQL_SKIP_LOCKED})
+                                   RETURNING id, chat_id, text, reply_markup, attempts""",
+                                (now + OUTBOX_LEASE, now, OUTBOX_BATCH)).fetchall()
+            db().commit()
+        except Exception as e:
+            print("outbox_worker error:", e)
+            rows = []
+        if not rows:
+            outbox_wakeup.wait(timeout=1.0)
+            outbox_wakeup.clear()
+            continue
+
+        sent, retry, in_flight = [], [], []
+        for row_id, chat_id, text, reply_markup, attempts in sorted(rows):
+            if (paused := global_bucket.paused_for()):
+                retry.append((time.time() + paused, attempts, row_id))
+                continue
+            bucket = chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE)
+                while len(chat_buckets) > 10000:
+                    chat_buckets.popitem(last=False)
+            chat_buckets.move_to_end(chat_id)
+            wait_chat = bucket.take()
+            if wait_chat:
+                retry.append((time.time() + wait_chat, attempts, row_id))
+                continue
+            while (wait_global := global_bucket.take()):
+                time.sleep(wait_global)
+            fut = asyncio.run_coroutine_threadsafe(_send_outbox_row(chat_id, text, reply_markup), ensure_io_loop())
+            fut.add_done_callback(pause_on_429)
+            in_flight.append((row_id, attempts, fut))
+
+        for row_id, attempts, fut in in_flight:
+            try:
+                res = fut.result(timeout=30)
+            except Exception as e:
+                res = {"ok": False, "error_code": 0, "description": str(e)}
+            if res.get("ok"):
+                sent.append((row_id,))
+                continue
+            code = res.get("error_code") or 0
+            if code == 429:
+                # Telegram impose le délai à tout le bot (global_bucket en pause via
+                # pause_on_429) : pas compté comme un échec
+                retry.append((time.time() + _retry_after(res), attempts, row_id))
+            elif code in (400, 403) or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                # chat introuvable / bot bloqué / trop d’essais : abandon
+                print("outbox drop:", row_id, code, res.get("description"))
+                sent.append((row_id,))
+            else:
+                retry.append((time.time() + min(2 ** attempts, 300), attempts + 1, row_id))
+
+        try:
+            cx = db()
+            cx.executemany("DELETE FROM outbox WHERE id=?", sent)
+            cx.executemany("UPDATE outbox SET next_at=?, attempts=? WHERE id=?", retry)
+            cx.commit()
+        except Exception as e:
+            print("outbox_worker error:", e)
 
 def menu_for(uid:int, registered:bool):
     if not registered:
@@ -336,7 +2050,7 @@ CONNECT_HTML = """
 </html>
 """
 
-@app.route("/ton/connect")
+@bp.route("/ton/connect")
 def ton_connect_page():
     uid   = request.args.get("uid","").strip()
     nonce = request.args.get("nonce","").strip()
@@ -352,7 +2066,7 @@ def ton_connect_page():
 # =========================
 # Enregistrement TON (POST) + auto-ouverture mini-app
 # =========================
-@app.route("/ton/submit", methods=["POST","OPTIONS"])
+@bp.route("/ton/submit", methods=["POST","OPTIONS"])
 def ton_submit():
     if request.method == "OPTIONS":
         return ("", 204)
@@ -364,71 +2078,80 @@ def ton_submit():
         if not uid or not address:
             return jsonify({"ok": False, "error": "missing uid/address"}), 400
 
-        # init user si besoin
-        upsert_user(uid)
-
-        # appliquer parrainage si nouveau et code valide
-        set_referral_if_empty(uid, ref)
+        # récupérer trophies depuis Bot2 avant d’ouvrir la transaction (pas d’appel réseau sous verrou) ;
+        # None (Bot2 en panne ou non configuré, ou mode push) → le total enregistré est conservé
+        total = None
+        if not BOT2_PUSH and BOT2_URL and API_SECRET:
+            total = trophy_cache.get(uid, timeout=6)
 
-        # enregistrer l’adresse
-        set_wallet(uid, address)
-
-        # récupérer trophies depuis Bot2 & stocker
-        total = get_pioches_from_bot2(uid)
-        update_trophies(uid, total)
-
-        # pousser un message (au cas où la WebView se ferme)
-        send_telegram_message_raw(
-            uid,
-            f"🔗 Wallet enregistré : <code>{address}</code>\n✅ Bienvenue !",
-            reply_markup={"inline_keyboard":[
-                [{"text":"🔎 Ouvrir la mini-app","web_app":{"url": f"{PUBLIC_BASE_URL}/app.html?uid={uid}"}}]
-            ]}
-        )
+        # une seule transaction : init user, parrainage, adresse, trophies, message
+        with tx():
+            row = upsert_user(uid)
+            set_referral_if_empty(uid, ref, me=row)
+            set_wallet(uid, address)
+            if total is not None:
+                update_trophies(uid, total, old=row[5])
+            # pousser un message (au cas où la WebView se ferme)
+            send_telegram_message_raw(
+                uid,
+                f"🔗 Wallet enregistré : <code>{address}</code>\n✅ Bienvenue !",
+                reply_markup={"inline_keyboard":[
+                    [{"text":"🔎 Ouvrir la mini-app","web_app":{"url": f"{PUBLIC_BASE_URL}/app.html?uid={uid}"}}]
+                ]}
+            )
+        # préchargement des NFT
+        request_nft_refresh(address)
         return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-@app.route("/ton/submit", methods=["GET"])
+@bp.route("/ton/submit", methods=["GET"])
 def ton_submit_get():
     return ("POST JSON {uid,address,ref}", 405)
 
 # =========================
 # API Mini-app
 # =========================
-@app.route("/app.html")
+@bp.route("/app.html")
 def app_html():
-    return render_template("app.html")  # templates/app.html
+    return serve_asset("app.html")  # templates/app.html, pré-rendu par build_assets
 
-@app.route("/api/me")
-def api_me():
-    uid = request.args.get("uid","").strip()
-    if not uid.isdigit():
-        return jsonify({"registered": False})
-    uid_i = int(uid)
-    row = get_user(uid_i)
+def build_me(uid:int) -> tuple[bytes, str]:
+    # corps JSON de /api/me + ETag (empreinte du corps)
+    row = get_user_view(uid)
     if not row:
-        return jsonify({"registered": False})
+        payload = {"registered": False}
+    else:
+        payload = me_payload(uid, row)
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode()
+    return body, hashlib.sha1(body).hexdigest()[:16]
 
+def me_payload(uid_i:int, row) -> dict:
+    # ligne get_user_view : inviter (username) et NFT en cache viennent de la même requête
     (telegram_id, username, wallet, personal_code, ref_used,
-     trophies_total, hat, jacket, pants, shoes, bracelet, _photo_path) = row
+     trophies_total, hat, jacket, pants, shoes, bracelet, _photo_path,
+     invited_by, nft_items) = row
+
+    # Bot2 et photo de profil en parallèle, avec un délai global :
+    # la latence est celle de l’appel le plus lent, pas la somme
+    calls = {"photo": (get_profile_photo_url, uid_i)}
+    if not BOT2_PUSH:
+        # sans push Bot2, users.trophies_total n’est tenu à jour que par ces lectures
+        calls["bot2"] = (get_pioches_from_bot2, uid_i, trophies_total)
+    res, timed_out = fan_out(calls, API_ME_DEADLINE, defaults={"bot2": None, "photo": None})
 
     # rafraîchir trophies depuis Bot2 à l’ouverture de la mini-app
-    total = get_pioches_from_bot2(uid_i)
-    if total != trophies_total:
-        update_trophies(uid_i, total)
+    total = res.get("bot2")
+    if total is not None and total != trophies_total:
+        update_trophies(uid_i, total, old=trophies_total)
         trophies_total = total
 
-    # inviter (username) si parrainage
-    invited_by = inviter_username_from_code(ref_used)
-
-    # photo de profil
-    photo_url = get_profile_photo_url(uid_i)
+    photo_url = res["photo"]
 
-    # NFT réels (si clé TONAPI)
-    nfts = fetch_nfts_for_wallet(wallet) if wallet else []
+    # NFT réels (si clé TONAPI), depuis nft_cache uniquement
+    nfts = get_cached_nfts(wallet, nft_items) if wallet else []
 
-    return jsonify({
+    return {
         "registered": True,
         "bot_username": BOT_USERNAME,
         "telegram_id": telegram_id,
@@ -440,19 +2163,51 @@ def api_me():
         "invited_by_username": invited_by,
         "pioches_total": trophies_total,
         "avatar": {"hat": hat, "jacket": jacket, "pants": pants, "shoes": shoes, "bracelet": bracelet},
-        "nfts": nfts
-    })
+        "nfts": nfts,
+        "timed_out": timed_out
+    }
+
+# Réouvertures rapprochées de la WebApp : réponse gardée ME_CACHE_TTL secondes par uid,
+# requêtes simultanées pour un même uid fusionnées, 304 si le client a déjà ce corps.
+me_cache = SWRCache(build_me, ME_CACHE_TTL, 0, ME_CACHE_MAX, name="me", inline=True)
+
+def invalidate_me(uid:int):
+    me_cache.invalidate(uid)
 
-@app.route("/api/mines")
+@bp.route("/api/me")
+def api_me():
+    uid = request.args.get("uid","").strip()
+    if not uid.isdigit():
+        return jsonify({"registered": False})
+    uid_i = int(uid)
+    entry = me_cache.get(uid_i, timeout=API_ME_DEADLINE + 2) if ME_CACHE_TTL > 0 else None
+    body, etag = entry or build_me(uid_i)
+    if etag in request.if_none_match:
+        resp = make_response("", 304)
+    else:
+        resp = make_response(body)
+        resp.headers["Content-Type"] = "application/json"
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+@bp.route("/api/referrals")
+def api_referrals():
+    # compteurs matérialisés : lecture par clé primaire + top via index, sans parcours récursif
+    uid = request.args.get("uid","").strip()
+    limit = request.args.get("limit","10")
+    limit = min(max(int(limit), 1), 100) if limit.isdigit() else 10
+    out = {"ok": True, "top": top_referrers(limit)}
+    if uid.isdigit():
+        out["telegram_id"] = int(uid)
+        out.update(referral_stats(int(uid)))
+    return jsonify(out)
+
+@bp.route("/api/mines")
 def api_mines():
-    mines = [
-        {"title":"Mine 1","url":"https://t.me/mine1"},
-        {"title":"Mine 2","url":"https://t.me/mine2"},
-        {"title":"Mine 3","url":"https://t.me/mine3"},
-    ]
-    return jsonify({"mines": mines})
-
-@app.route("/api/avatar/update", methods=["POST"])
+    return serve_asset("api/mines")
+
+@bp.route("/api/avatar/update", methods=["POST"])
 def api_avatar_update():
     data = request.get_json() or {}
     uid = int(data.get("uid") or 0)
@@ -460,56 +2215,306 @@ def api_avatar_update():
     hat = data.get("hat","none"); jacket=data.get("jacket","none")
     pants=data.get("pants","none"); shoes=data.get("shoes","none")
     bracelet = data.get("bracelet","metal")
-    c.execute("""UPDATE users
-                 SET hat=?, jacket=?, pants=?, shoes=?, bracelet=?
-                 WHERE telegram_id=?""",
-              (hat, jacket, pants, shoes, bracelet, uid))
-    conn.commit()
+    if buffer_user_write(uid, hat=hat, jacket=jacket, pants=pants, shoes=shoes, bracelet=bracelet):
+        invalidate_me(uid)
+        return jsonify({"ok": True})
+    discard_user_writes(uid, "hat", "jacket", "pants", "shoes", "bracelet")
+    with tx():
+        db().execute("""UPDATE users
+                     SET hat=?, jacket=?, pants=?, shoes=?, bracelet=?
+                     WHERE telegram_id=?""",
+                  (hat, jacket, pants, shoes, bracelet, uid))
+        after_commit(invalidate_me, uid)
     return jsonify({"ok": True})
 
-@app.route("/api/unsubscribe", methods=["POST"])
+@bp.route("/api/unsubscribe", methods=["POST"])
 def api_unsubscribe():
     data = request.get_json() or {}
     uid = int(data.get("uid") or 0)
     if not uid: return jsonify({"ok": False, "error":"uid required"}), 400
-    c.execute("DELETE FROM users WHERE telegram_id=?", (uid,))
-    conn.commit()
+    delete_user(uid)
     try:
         send_telegram_message_raw(uid, "🗑️ Ton compte a été supprimé.")
     except: pass
     return jsonify({"ok": True})
 
+def api_secret_ok(data:dict|None=None) -> bool:
+    # routes internes : en-tête X-API-Secret (ou champ "secret") = API_SECRET
+    secret = request.headers.get("X-API-Secret") or (data or {}).get("secret") or ""
+    return bool(API_SECRET) and secrets.compare_digest(secret, API_SECRET)
+
+@bp.route("/api/upstreams")
+def api_upstreams():
+    if not api_secret_ok():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    return jsonify({"ok": True, "upstreams": upstream_stats_snapshot()})
+
+@bp.route("/api/broadcast", methods=["POST"])
+def api_broadcast():
+    # réservé aux services internes (même secret que Bot2)
+    data = request.get_json() or {}
+    if not api_secret_ok(data):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    text = (data.get("text") or "").strip()
+    if not text: return jsonify({"ok": False, "error":"text required"}), 400
+    queued = broadcast_message(text, data.get("reply_markup"))
+    return jsonify({"ok": True, "queued": queued})
+
+JSONL_MIMETYPES = ("application/x-ndjson", "application/jsonl", "application/x-jsonlines")
+
+@bp.route("/api/trophies/push", methods=["POST"])
+def api_trophies_push():
+    # Bot2 → Bot1 : [{"telegram_id": 1, "total": 12}, {"telegram_id": 2, "delta": 3}, ...]
+    # en JSON (liste, ou {"updates": [...]}) ou en JSONL (une mise à jour par ligne, secret en en-tête)
+    # en-tête X-API-Secret vérifié avant de lire le corps ; corps borné à TROPHY_PUSH_MAX_BYTES.
+    # Ancien format {"secret": ..., "updates": [...]} (secret dans le corps, donc vérifié après
+    # décodage) : accepté seulement jusqu’à TROPHY_PUSH_LEGACY_MAX_BYTES
+    header_secret = "X-API-Secret" in request.headers
+    if header_secret and not api_secret_ok():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    limit = TROPHY_PUSH_MAX_BYTES if header_secret else TROPHY_PUSH_LEGACY_MAX_BYTES
+    too_large = "payload too large" if header_secret else "payload too large without X-API-Secret header"
+    if (request.content_length or 0) > limit:
+        return jsonify({"ok": False, "error": too_large}), 413
+    body = request.stream.read(limit + 1)
+    if len(body) > limit:
+        return jsonify({"ok": False, "error": too_large}), 413
+    try:
+        text = body.decode("utf-8")
+        if request.mimetype in JSONL_MIMETYPES:
+            data = None
+            updates = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            data = json.loads(text or "null")
+            updates = data.get("updates") if isinstance(data, dict) else data
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid json"}), 400
+    if not header_secret and not api_secret_ok(data if isinstance(data, dict) else None):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    if not isinstance(updates, list):
+        return jsonify({"ok": False, "error": "updates required"}), 400
+    items = []
+    for i, u in enumerate(updates):
+        uid = u.get("telegram_id") if isinstance(u, dict) else None
+        total = u.get("total") if isinstance(u, dict) else None
+        delta = u.get("delta", 0) if isinstance(u, dict) else None
+        if (type(uid) is not int or (total is not None and type(total) is not int)
+                or type(delta) is not int or (total is None and "delta" not in u)):
+            return jsonify({"ok": False, "error": f"invalid update #{i}"}), 400
+        items.append((uid, total, delta))
+    # telegram_id inconnus : signalés à Bot2 plutôt qu’ignorés en silence à l’écriture
+    known = existing_user_ids({uid for uid, _, _ in items})
+    unknown = sorted({uid for uid, _, _ in items} - known)
+    items = [item for item in items if item[0] in known]
+    pending = push_trophies(items)
+    return jsonify({"ok": True, "accepted": len(items), "unknown": unknown, "pending": pending}), 202
+
+# =========================
+# Classement trophées
+# =========================
+# Top-N lu via idx_users_trophies (pas de tri complet) et gardé en mémoire
+# LEADERBOARD_TTL secondes ; invalidé dès qu’un changement peut toucher le top.
+_leaderboard = {"rows": None, "at": 0.0, "floor": None}
+_leaderboard_lock = Lock()
+
+def leaderboard_top() -> list[dict]:
+    with _leaderboard_lock:
+        if _leaderboard["rows"] is not None and time.monotonic() - _leaderboard["at"] < LEADERBOARD_TTL:
+            cache_requests.inc("leaderboard", "hit")
+            return _leaderboard["rows"]
+    cache_requests.inc("leaderboard", "miss")
+    rows = db().execute("""SELECT telegram_id, username, trophies_total FROM users
+                           ORDER BY trophies_total DESC, telegram_id LIMIT ?""", (LEADERBOARD_TOP_MAX,)).fetchall()
+    top, prev, rank = [], None, 0
+    for i, (tid, username, trophies) in enumerate(rows, start=1):
+        if trophies != prev:
+            rank, prev = i, trophies
+        top.append({"rank": rank, "telegram_id": tid, "username": username, "trophies": trophies})
+    with _leaderboard_lock:
+        _leaderboard.update(rows=top, at=time.monotonic(),
+                            floor=top[-1]["trophies"] if len(top) == LEADERBOARD_TOP_MAX else None)
+    return top
+
+def leaderboard_touch(old:int, new:int):
+    # floor None = top incomplet : tout changement le concerne
+    with _leaderboard_lock:
+        floor = _leaderboard["floor"]
+        if _leaderboard["rows"] is not None and (floor is None or max(old, new) >= floor):
+            _leaderboard["rows"] = None
+
+@bp.route("/api/leaderboard")
+def api_leaderboard():
+    limit = request.args.get("limit","20")
+    limit = min(max(int(limit), 1), LEADERBOARD_TOP_MAX) if limit.isdigit() else 20
+    out = {"ok": True, "top": leaderboard_top()[:limit]}
+    uid = request.args.get("uid","").strip()
+    if uid.isdigit():
+        row = db().execute("SELECT trophies_total FROM users WHERE telegram_id=?", (int(uid),)).fetchone()
+        if row:
+            out["me"] = {"telegram_id": int(uid), "trophies": row[0], "rank": trophy_rank(row[0] or 0)}
+    return jsonify(out)
+
 # =========================
 # Dashboard ultra simple (optionnel)
 # =========================
+# Pagination par clé (telegram_id > after) : coût constant quelle que soit la page,
+# recherche servie par les index, export en flux par paquets.
+DASH_PAGE_SIZE = 100
+DASH_PAGE_MAX = 500
+EXPORT_CHUNK = 1000
+DASH_COLUMNS = ("telegram_id", "username", "wallet_address", "personal_code", "referral_code_used", "trophies_total")
+
 DASH_HTML = """
 <!doctype html><html><head><meta charset="utf-8"><title>Dashboard</title></head><body>
 <h2>Users</h2>
+<form method="get">
+<input name="q" value="{{q}}" placeholder="username, wallet ou code">
+<button>Rechercher</button>
+<a href="/dashboard/export.csv?q={{q|urlencode}}">CSV</a>
+<a href="/dashboard/export.jsonl?q={{q|urlencode}}">JSONL</a>
+</form>
 <table border="1" cellpadding="6">
 <tr><th>tg_id</th><th>username</th><th>wallet</th><th>code</th><th>ref_used</th><th>trophies</th></tr>
 {% for u in users %}
 <tr><td>{{u[0]}}</td><td>{{u[1]}}</td><td>{{u[2]}}</td><td>{{u[3]}}</td><td>{{u[4]}}</td><td>{{u[5]}}</td></tr>
 {% endfor %}
 </table>
+{% if next_after %}<p><a href="/dashboard?q={{q|urlencode}}&limit={{limit}}&after={{next_after}}">Page suivante →</a></p>{% endif %}
 </body></html>
 """
-@app.route("/dashboard")
+
+def dashboard_page(q:str, after:int, limit:int):
+    cols = ", ".join(DASH_COLUMNS)
+    if not q:
+        return db().execute(f"SELECT {cols} FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?",
+                            (after, limit)).fetchall()
+    # un sous-ensemble par index (UNION), puis tri des seuls résultats ; un OR forcerait un scan complet
+    # `_` (fréquent dans les usernames) reste un joker LIKE : il élargit à peine le préfixe,
+    # alors qu’un ESCAPE désactiverait l’optimisation LIKE → index de SQLite
+    prefix = q.lstrip("@").replace("%", "")
+    return db().execute(f"""SELECT {cols} FROM users WHERE telegram_id IN (
+                                SELECT telegram_id FROM users WHERE {SQL_USERNAME_PREFIX}
+                                UNION SELECT telegram_id FROM users WHERE wallet_address >= ? AND wallet_address < ?
+                                UNION SELECT telegram_id FROM users WHERE personal_code = ?)
+                            AND telegram_id > ? ORDER BY telegram_id LIMIT ?""",
+                        (prefix + "%", q, q + "\U0010ffff", q.upper(), after, limit)).fetchall()
+
+def _page_args():
+    q = request.args.get("q", "").strip()
+    after = request.args.get("after", "0")
+    limit = request.args.get("limit", str(DASH_PAGE_SIZE))
+    after = int(after) if after.lstrip("-").isdigit() else 0
+    limit = min(max(int(limit), 1), DASH_PAGE_MAX) if limit.isdigit() else DASH_PAGE_SIZE
+    return q, after, limit
+
+@bp.route("/dashboard")
 def dashboard():
-    c.execute("SELECT telegram_id, username, wallet_address, personal_code, referral_code_used, trophies_total FROM users")
-    users = c.fetchall()
-    return render_template_string(DASH_HTML, users=users)
+    q, after, limit = _page_args()
+    users = dashboard_page(q, after, limit)
+    next_after = users[-1][0] if len(users) == limit else None
+    return render_template_string(DASH_HTML, users=users, q=q, limit=limit, next_after=next_after)
+
+def _export_rows(q:str):
+    after = 0
+    while True:
+        rows = dashboard_page(q, after, EXPORT_CHUNK)
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0]
+
+@bp.route("/dashboard/export.csv")
+def dashboard_export_csv():
+    q = request.args.get("q", "").strip()
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(DASH_COLUMNS)
+        for rows in _export_rows(q):
+            writer.writerows(rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+    return Response(stream_with_context(generate()), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=users.csv"})
+
+@bp.route("/dashboard/export.jsonl")
+def dashboard_export_jsonl():
+    q = request.args.get("q", "").strip()
+    def generate():
+        for rows in _export_rows(q):
+            yield "".join(json.dumps(dict(zip(DASH_COLUMNS, r)), ensure_ascii=False) + "\n" for r in rows)
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"Content-Disposition": "attachment; filename=users.jsonl"})
 
 # =========================
 # Telegram Bot
 # =========================
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+_application = None
+_application_pid = None
+_application_lock = Lock()
+
+def get_application() -> Application:
+    # construit au premier usage (run, webhook) : l’import et les workers web n’en paient pas le coût
+    global _application, _application_pid
+    with _application_lock:
+        if _application is None or _application_pid != os.getpid():
+            _application_pid = os.getpid()
+            check_config()
+            builder = (Application.builder().token(TELEGRAM_TOKEN)
+                       .base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot"))
+            if BOT_CONCURRENCY > 1:
+                # updates de chats différents traités en parallèle ; per_user() garde l’ordre par utilisateur
+                builder = builder.concurrent_updates(BOT_CONCURRENCY).connection_pool_size(BOT_CONCURRENCY)
+            application = builder.build()
+            application.add_handler(CommandHandler("start", timed_handler("start", per_user(start_cmd))))
+            application.add_handler(CallbackQueryHandler(timed_handler("callback", per_user(any_callback)), pattern=".*"))
+            _application = application
+        return _application
+
+# Les handlers sont async : le travail bloquant (DB) part sur ce pool pour ne pas
+# figer la boucle du bot (partagée avec le serveur web en mode asgi).
+bot_db_pool = ThreadPoolExecutor(max_workers=BOT_DB_WORKERS, thread_name_prefix="bot-db")
+
+async def off_loop(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(bot_db_pool, partial(fn, *args))
+
+_user_locks: dict[int, list] = {}   # uid -> [asyncio.Lock, updates en cours]
+
+def per_user(fn):
+    # updates d’un même utilisateur traités dans l’ordre d’arrivée (verrou FIFO par uid)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None or BOT_CONCURRENCY <= 1:
+            return await fn(update, context)
+        entry = _user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await fn(update, context)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _user_locks[user.id]
+    return wrapper
+
+def start_user(uid:int, username:str|None, payload:str) -> tuple[bool, str]:
+    # partie DB de /start → (wallet présent ?, code parrain à passer à /ton/connect)
+    # une seule transaction : init user + parrainage
+    with tx():
+        # upsert de base (crée personal_code si nouveau) ; la ligne sert pour toute la suite
+        row = upsert_user(uid, username)
+        # appliquer parrainage si présent
+        ref = row[4] or ""
+        if payload and set_referral_if_empty(uid, payload, me=row):
+            ref = payload
+    return row[2] is not None, ref
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     uid = user.id
     username = user.username
-    # upsert de base (crée personal_code si nouveau)
-    upsert_user(uid, username)
 
     # deep-link /start <payload> ou /start startapp=... → on accepte tout
     payload = ""
@@ -521,17 +2526,11 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if payload.startswith("startapp="):
                 payload = payload.split("=",1)[1]
 
-    # appliquer parrainage si présent
-    if payload:
-        set_referral_if_empty(uid, payload)
-
-    registered = is_user_registered(uid) and (get_user(uid)[2] is not None)  # wallet présent ?
+    registered, ref = await off_loop(start_user, uid, username, payload)
     if not registered:
         # montrer Connect + ouvrir mini-app automatiquement après /ton/submit
         nonce = secrets.token_hex(8)
         # si parrainage existant, on passe ref dans l’URL pour CONNECT
-        c.execute("SELECT referral_code_used FROM users WHERE telegram_id=?", (uid,))
-        ref = (c.fetchone() or [None])[0] or ""
         btn = InlineKeyboardMarkup([
             [InlineKeyboardButton("🔗 Connect TON Wallet",
               web_app=WebAppInfo(url=f"{PUBLIC_BASE_URL}/ton/connect?uid={uid}&nonce={nonce}&ref={ref}"))]
@@ -560,18 +2559,279 @@ async def any_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ])
     )
 
-application.add_handler(CommandHandler("start", start_cmd))
-application.add_handler(CallbackQueryHandler(any_callback, pattern=".*"))
+def timed_handler(name:str, fn):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, context)
+        finally:
+            bot_latency.observe(time.perf_counter() - t0, name)
+    return wrapper
+
+
+# =========================
+# Webhook Telegram (BOT_MODE=webhook)
+# =========================
+# Les updates arrivent sur une route de l’app web : plusieurs répliques peuvent
+# tourner derrière un load balancer. Test local : POST d’un Update JSON enregistré
+# avec l’en-tête X-Telegram-Bot-Api-Secret-Token.
+@bp.route(WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not secrets.compare_digest(token, WEBHOOK_SECRET):
+        return ("forbidden", 403)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or "update_id" not in data:
+        return ("bad update", 400)
+    application = _application
+    if BOT_MODE != "webhook" or _bot_pid != os.getpid() or application is None or not application.running:
+        # bot pas (encore) démarré dans ce processus, ou en polling sur une autre boucle :
+        # 503 pour que Telegram renvoie l’update plus tard
+        return ("bot not running", 503)
+    update = Update.de_json(data, application.bot)
+    # le bot tourne sur io_loop : on dépose l’update dans sa file et on répond tout de suite
+    run_io(application.update_queue.put(update), timeout=5)
+    return ("", 200)
+
+async def start_bot_webhook():
+    application = get_application()
+    await application.initialize()
+    await application.start()
+    await application.bot.set_webhook(
+        url=f"{PUBLIC_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+    )
+
+_bot_pid = None
+_bot_lock = Lock()
+
+def start_bot():
+    # BOT_MODE=webhook : bot initialisé et démarré sur io_loop une fois par processus.
+    # get_app() l’appelle (gunicorn main:app), comme __main__ ; le lifespan ASGI le fait lui-même.
+    global _bot_pid
+    with _bot_lock:
+        if _bot_pid == os.getpid():
+            return
+        run_io(start_bot_webhook(), timeout=60)
+        _bot_pid = os.getpid()
 
 # =========================
 # Run
 # =========================
 def run_flask():
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT","8080")))
+    get_app().run(host="0.0.0.0", port=int(os.getenv("PORT","8080")))
 
 def run_bot():
-    application.run_polling()
+    get_application().run_polling()
+
+def flush_buffers():
+    # à l’arrêt : rien ne doit rester en mémoire
+    for flush in (flush_trophy_push, flush_user_writes):
+        try:
+            flush()
+        except Exception as e:
+            print("flush_buffers error:", e)
+
+_workers_pid = None
+_workers_lock = Lock()
+
+def start_workers():
+    # tâches de fond : outbox Telegram, rafraîchissement NFT, synchro et push trophées,
+    # écritures différées. Une fois par processus : get_app() (gunicorn main:app), __main__
+    # et le lifespan ASGI l’appellent ; buffers vidés à la sortie du processus.
+    global _workers_pid
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+    atexit.register(flush_buffers)
+    Thread(target=outbox_worker, daemon=True, name="outbox").start()
+    if TONAPI_KEY:
+        Thread(target=nft_refresher, daemon=True, name="nft-refresher").start()
+    if BOT2_URL and API_SECRET and TROPHY_SYNC_INTERVAL > 0:
+        Thread(target=trophy_sync_worker, daemon=True, name="trophy-sync").start()
+    if API_SECRET:
+        Thread(target=trophy_push_worker, daemon=True, name="trophy-push").start()
+    if WRITE_BEHIND_INTERVAL > 0:
+        Thread(target=write_behind_worker, daemon=True, name="write-behind").start()
+
+@bp.before_app_request
+def _ensure_workers():
+    # gunicorn --preload : l’app est créée dans le maître, ses threads ne survivent pas au fork
+    if _workers_pid != os.getpid():
+        start_workers()
+    if BOT_MODE == "webhook" and _bot_pid != os.getpid():
+        start_bot()
+
+# Mode ASGI : bot PTB et clients httpx sur la boucle d’uvicorn. Les vues Flask (WSGI)
+# tournent dans wsgi_pool (ASGI_WSGI_WORKERS requêtes à la fois) ; leurs appels
+# amont reviennent sur cette boucle via run_io().
+_wsgi_bridge = None
+wsgi_pool = None
+
+def make_wsgi_bridge(wsgi_app):
+    # pont ASGI → WSGI minimal : corps de requête lu sur la boucle, vue Flask exécutée
+    # dans wsgi_pool, morceaux de réponse renvoyés à la boucle au fil de l’eau
+    global wsgi_pool
+    import sys
+    from tempfile import SpooledTemporaryFile
+    wsgi_pool = ThreadPoolExecutor(max_workers=ASGI_WSGI_WORKERS, thread_name_prefix="wsgi")
+
+    def environ_for(scope, body):
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope["query_string"].decode("ascii"),
+            "SERVER_PROTOCOL": "HTTP/" + scope["http_version"],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        server = scope.get("server") or ("localhost", 80)
+        environ["SERVER_NAME"], environ["SERVER_PORT"] = server[0], str(server[1] or 0)
+        if scope.get("client"):
+            environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+        for name, value in scope.get("headers", []):
+            name, value = name.decode("latin1"), value.decode("latin1")
+            key = {"content-length": "CONTENT_LENGTH", "content-type": "CONTENT_TYPE"}.get(
+                name, "HTTP_" + name.upper().replace("-", "_"))
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def run_app(environ, emit):
+        # thread du pool : emit() pousse ("start", status, headers) puis ("body", bytes)…
+        def start_response(status, headers, exc_info=None):
+            emit(("start", int(status.split(" ", 1)[0]),
+                  [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers]))
+            return lambda data: emit(("body", data))
+        result = wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    emit(("body", chunk))
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    async def bridge(scope, receive, send):
+        if scope["type"] != "http":
+            raise ValueError(f"type de scope non géré : {scope['type']}")
+        body = SpooledTemporaryFile(max_size=65536)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return
+            body.write(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body.seek(0)
+        loop = asyncio.get_running_loop()
+        out = asyncio.Queue()
+        emit = lambda item: loop.call_soon_threadsafe(out.put_nowait, item)
+        job = loop.run_in_executor(wsgi_pool, run_app, environ_for(scope, body), emit)
+        job.add_done_callback(lambda _: out.put_nowait(None))
+        try:
+            started = False
+            while (item := await out.get()) is not None:
+                if item[0] == "start":
+                    pending_start = item
+                    continue
+                if not started:
+                    started = True
+                    await send({"type": "http.response.start", "status": pending_start[1],
+                                "headers": pending_start[2]})
+                await send({"type": "http.response.body", "body": item[1], "more_body": True})
+            await job
+            if not started:
+                await send({"type": "http.response.start", "status": pending_start[1],
+                            "headers": pending_start[2]})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            body.close()
+
+    return bridge
+
+async def _asgi_startup():
+    global io_loop, _io_loop_pid, _bot_pid
+    io_loop, _io_loop_pid = asyncio.get_running_loop(), os.getpid()
+    _bot_pid = os.getpid()   # démarré ici, sur la boucle d’uvicorn : get_app() n’y touche pas
+    if BOT_MODE == "webhook":
+        await start_bot_webhook()
+    else:
+        application = get_application()
+        await application.initialize()
+        await application.start()
+        await application.updater.start_polling()
+    start_workers()
+
+async def _asgi_shutdown():
+    application = get_application()
+    if application.updater.running:
+        await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await close_http_clients()
+    # pushes Bot2 et écritures différées encore en mémoire
+    await asyncio.get_running_loop().run_in_executor(None, flush_buffers)
+
+async def asgi_app(scope, receive, send):
+    global _wsgi_bridge
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await _asgi_startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await _asgi_shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if _wsgi_bridge is None:
+        _wsgi_bridge = make_wsgi_bridge(get_app())
+    await _wsgi_bridge(scope, receive, send)
+
+def run_asgi():
+    import uvicorn
+    uvicorn.run(asgi_app, host="0.0.0.0", port=int(os.getenv("PORT","8080")), lifespan="on")
+
+def __getattr__(name:str):
+    # main.app / main.application : créés au premier accès (gunicorn main:app, scripts)
+    if name == "app":
+        return get_app()
+    if name == "application":
+        return get_application()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
-    Thread(target=run_flask, daemon=True).start()
-    run_bot()
+    import sys
+    if sys.argv[1:] == ["migrate"]:
+        before, after = migrate()
+        print(f"schéma : v{before} → v{after}" if after != before else f"schéma à jour (v{after})")
+        sys.exit(0)
+    if sys.argv[1:] == ["rebuild"]:
+        print(f"classement et parrainage recalculés ({rebuild_derived_tables()} utilisateurs)")
+        sys.exit(0)
+    if DB_AUTO_MIGRATE:
+        migrate()
+    if SERVER_MODE == "asgi":
+        run_asgi()
+    elif BOT_MODE == "webhook":
+        # bot sur io_loop, Flask sur le thread principal
+        start_bot()
+        start_workers()
+        run_flask()
+    else:
+        Thread(target=run_flask, daemon=True).start()
+        start_workers()
+        run_bot()
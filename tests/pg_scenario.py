@@ -0,0 +1,83 @@
+# lancé par test_postgres.py dans un processus neuf (DATABASE_URL est lu à l’import de main)
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+def histogram_ok(cx):
+    hist = sorted(r for r in cx.execute("SELECT trophies, users FROM trophy_histogram").fetchall() if r[1])
+    return hist == sorted(cx.execute("SELECT trophies_total, COUNT(*) FROM users GROUP BY 1").fetchall())
+
+def main_():
+    assert main.DB_IS_PG
+    assert main.migrate() == (0, len(main.MIGRATIONS))
+    assert main.migrate() == (len(main.MIGRATIONS), len(main.MIGRATIONS))
+    cx = main.db()
+
+    # INSERT ... ON CONFLICT ... RETURNING, puis lecture simple
+    a = main.upsert_user(1, "alice")
+    assert a[:2] == (1, "alice") and a[5] == 0
+    assert main.upsert_user(1, "alice") == a
+    assert main.upsert_user(1, "alice_2")[1] == "alice_2"
+    b = main.upsert_user(2, "bob")
+    c = main.upsert_user(3, "carol")
+
+    # parrainage : CTE récursive (CAST), compteurs par niveau, pas de boucle
+    assert main.set_referral_if_empty(2, a[3], me=b)
+    assert main.set_referral_if_empty(3, b[3], me=c)
+    assert not main.set_referral_if_empty(1, c[3])
+    assert main.referral_ancestors(3, 3) == [2, 1]
+    assert main.referral_stats(1) == {"direct": 1, "levels": {"1": 1, "2": 1, "3": 0}, "total": 2}
+    view = main.get_user_view(3)
+    assert view[12] == "bob" and view[13] is None
+
+    # trophées : UPDATE conditionnel, écriture groupée, histogramme et rang
+    main.update_trophies(1, 40)
+    main.update_trophies(2, 10, old=0)
+    assert main.update_trophies_many({3: 25}, {1: 2, 99: 5}) == {1: 42, 3: 25}
+    assert histogram_ok(cx)
+    assert main.trophy_rank(42) == 1 and main.trophy_rank(10) == 3
+
+    # écritures groupées concurrentes sur les mêmes utilisateurs : l’histogramme reste juste
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: main.update_trophies_many({1: i % 7, 2: i % 5, 3: i % 3}, {1: 1}), range(200)))
+    assert histogram_ok(cx)
+
+    # parrainages simultanés le long d’une même chaîne : compteurs identiques au recalcul complet
+    users = {uid: main.upsert_user(uid, f"u{uid}") for uid in range(10, 40)}
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda uid: main.set_referral_if_empty(uid, users[uid - 1][3]), range(11, 40)))
+    counts = sorted(cx.execute("SELECT * FROM referral_counts").fetchall())
+    main.rebuild_derived_tables()
+    assert sorted(cx.execute("SELECT * FROM referral_counts").fetchall()) == counts
+
+    # recherche dashboard (lower(...) LIKE lower(?))
+    assert [r[0] for r in main.dashboard_page("ALICE_", 0, 10)] == [1]
+
+    # outbox : UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING
+    main.enqueue_message(1, "hello", {"inline_keyboard": []})
+    rows = cx.execute(f"""UPDATE outbox SET next_at=?
+                          WHERE id IN (SELECT id FROM outbox WHERE next_at<=? ORDER BY next_at, id LIMIT ?{main.SQL_SKIP_LOCKED})
+                          RETURNING id, chat_id, text, reply_markup, attempts""", (time.time() + 60, time.time(), 10)).fetchall()
+    assert [(r[1], r[2], json.loads(r[3])) for r in rows] == [(1, "hello", {"inline_keyboard": []})]
+
+    # suppression : sous-arbre retiré des compteurs du parrain
+    main.delete_user(2)
+    assert main.get_user(2) is None
+    assert main.referral_stats(1)["total"] == 0 and histogram_ok(cx)
+
+    # recalcul complet identique à l’état incrémental
+    counts = sorted(cx.execute("SELECT * FROM referral_counts").fetchall())
+    hist = sorted(cx.execute("SELECT * FROM trophy_histogram WHERE users > 0").fetchall())
+    main.rebuild_derived_tables()
+    assert sorted(cx.execute("SELECT * FROM referral_counts").fetchall()) == counts
+    assert sorted(cx.execute("SELECT * FROM trophy_histogram").fetchall()) == hist
+
+if __name__ == "__main__":
+    main_()
+    print("ok")
+    sys.exit(0)
@@ -0,0 +1,147 @@
+# PgConnection / tx() sans serveur PostgreSQL : pool et connexions factices
+from contextlib import contextmanager
+
+import pytest
+
+import main
+
+INERROR = 3   # psycopg.pq.TransactionStatus.INERROR
+IDLE, INTRANS = 0, 2
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, sql, params=()):
+        self.conn.run(sql, params)
+        if sql.lstrip().upper().startswith("SELECT"):
+            self.description = [("col",)]
+        self.rowcount = 1
+
+    def executemany(self, sql, seq):
+        for params in seq:
+            self.conn.run(sql, params)
+        self.rowcount = len(seq)
+
+    def fetchall(self):
+        return list(self.conn.rows)
+
+class FakeInfo:
+    transaction_status = IDLE
+
+class FakeConn:
+    def __init__(self, rows=()):
+        self.rows = rows
+        self.log = []
+        self.info = FakeInfo()
+
+    def run(self, sql, params):
+        self.log.append((sql, params))
+        if "boom" in sql:
+            if self.info.transaction_status == INTRANS:
+                self.info.transaction_status = INERROR
+            raise RuntimeError("erreur SQL")
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def execute(self, sql):
+        # ordres de contrôle de transaction (connexion psycopg)
+        self.log.append((sql, None))
+        if sql == "BEGIN":
+            self.info.transaction_status = INTRANS
+        elif sql in ("COMMIT", "ROLLBACK"):
+            self.info.transaction_status = IDLE
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+        self.out = 0
+
+    @contextmanager
+    def connection(self):
+        self.out += 1
+        try:
+            yield self.conn
+        finally:
+            self.out -= 1
+
+    def getconn(self):
+        self.out += 1
+        return self.conn
+
+    def putconn(self, conn):
+        assert conn is self.conn
+        self.out -= 1
+
+@pytest.fixture
+def pg(monkeypatch):
+    conn = FakeConn(rows=[(1, "alice")])
+    pool = FakePool(conn)
+    cx = main.PgConnection(pool)
+    monkeypatch.setattr(main, "db", lambda: cx)
+    main._db_local.tx_depth = 0
+    return cx, conn, pool
+
+def sqls(conn):
+    return [sql for sql, _ in conn.log]
+
+def test_placeholders_translated():
+    assert main._pg_sql("SELECT a FROM t WHERE b=? AND c LIKE 'x%' AND d=?") == \
+        "SELECT a FROM t WHERE b=%s AND c LIKE 'x%%' AND d=%s"
+
+def test_execute_outside_tx_borrows_and_returns(pg):
+    cx, conn, pool = pg
+    res = cx.execute("SELECT telegram_id, username FROM users WHERE telegram_id=?", (1,))
+    assert res.fetchone() == (1, "alice")
+    assert conn.log == [("SELECT telegram_id, username FROM users WHERE telegram_id=%s", (1,))]
+    assert pool.out == 0 and not cx.in_transaction
+
+def test_tx_commits_once_and_runs_after_commit(pg):
+    cx, conn, pool = pg
+    done = []
+    with main.tx():
+        cx.execute("UPDATE users SET hat=? WHERE telegram_id=?", ("cap", 1))
+        with main.tx():
+            cx.executemany("UPDATE users SET trophies_total=? WHERE telegram_id=?", [(1, 1), (2, 2)])
+            main.after_commit(done.append, "x")
+        assert cx.in_transaction and pool.out == 1 and done == []
+    assert sqls(conn) == ["BEGIN", "UPDATE users SET hat=%s WHERE telegram_id=%s",
+                          "UPDATE users SET trophies_total=%s WHERE telegram_id=%s",
+                          "UPDATE users SET trophies_total=%s WHERE telegram_id=%s", "COMMIT"]
+    assert done == ["x"] and pool.out == 0 and not cx.in_transaction
+
+def test_tx_rolls_back_on_exception(pg):
+    cx, conn, pool = pg
+    done = []
+    with pytest.raises(ValueError):
+        with main.tx():
+            cx.execute("UPDATE users SET hat=? WHERE telegram_id=?", ("cap", 1))
+            main.after_commit(done.append, "x")
+            raise ValueError
+    assert sqls(conn)[-1] == "ROLLBACK" and "COMMIT" not in sqls(conn)
+    assert done == [] and pool.out == 0 and not cx.in_transaction
+
+def test_commit_after_swallowed_error_rolls_back(pg):
+    pytest.importorskip("psycopg")
+    cx, conn, pool = pg
+    with pytest.raises(RuntimeError, match="annulée"):
+        with main.tx():
+            try:
+                cx.execute("UPDATE boom SET x=?", (1,))
+            except RuntimeError:
+                pass    # l’appelant ignore l’erreur : le COMMIT ne doit pas passer en silence
+    assert sqls(conn)[-1] == "ROLLBACK" and "COMMIT" not in sqls(conn)
+    assert pool.out == 0 and not cx.in_transaction
+
+def test_begin_failure_releases_connection(pg, monkeypatch):
+    cx, conn, pool = pg
+    def broken(sql):
+        raise RuntimeError("connexion perdue")
+    monkeypatch.setattr(conn, "execute", broken)
+    with pytest.raises(RuntimeError):
+        with main.tx():
+            pass
+    assert pool.out == 0 and not cx.in_transaction
@@ -0,0 +1,39 @@
+# SQL PostgreSQL réel (migrations, RETURNING, CTE récursive, SKIP LOCKED, verrous) :
+# TEST_DATABASE_URL=postgresql://... ou serveur embarqué pgserver ; ignoré sinon
+import os
+import subprocess
+import sys
+import uuid
+from urllib.parse import urlsplit
+
+import pytest
+
+psycopg = pytest.importorskip("psycopg")
+pytest.importorskip("psycopg_pool")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture(scope="module")
+def server_url(tmp_path_factory):
+    url = os.getenv("TEST_DATABASE_URL")
+    if url:
+        return url
+    pgserver = pytest.importorskip("pgserver")
+    return pgserver.get_server(str(tmp_path_factory.mktemp("pgdata")), cleanup_mode="stop").get_uri()
+
+@pytest.fixture
+def database_url(server_url):
+    # base neuve par test, supprimée ensuite
+    name = f"bot_test_{uuid.uuid4().hex[:8]}"
+    with psycopg.connect(server_url, autocommit=True) as cx:
+        cx.execute(f"CREATE DATABASE {name}")
+    yield urlsplit(server_url)._replace(path=f"/{name}").geturl()
+    with psycopg.connect(server_url, autocommit=True) as cx:
+        cx.execute(f"DROP DATABASE {name} WITH (FORCE)")
+
+def test_migrate_and_user_helpers(database_url, tmp_path):
+    env = dict(os.environ, DATABASE_URL=database_url, DB_FILE=str(tmp_path / "local.db"))
+    res = subprocess.run([sys.executable, os.path.join(HERE, "pg_scenario.py")], env=env,
+                         capture_output=True, text=True, timeout=300)
+    assert res.returncode == 0, res.stderr
+    assert res.stdout.strip().endswith("ok")
@@ -0,0 +1,81 @@
+# écritures différées (WRITE_BEHIND_INTERVAL > 0) sur une base SQLite temporaire
+import pytest
+
+import main
+
+@pytest.fixture
+def wb(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DB_FILE", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(main, "WRITE_BEHIND_INTERVAL", 0.5)
+    monkeypatch.setattr(main, "_pending_writes", {})
+    monkeypatch.setattr(main, "_flushing_writes", {})
+    main._db_local.__dict__.clear()
+    main.migrate()
+    for uid in (1, 2):
+        main.upsert_user(uid, f"user{uid}")
+    yield main.db()
+    main.db().close()
+    main._db_local.__dict__.clear()
+
+def stored(cx, uid, col):
+    return cx.execute(f"SELECT {col} FROM users WHERE telegram_id=?", (uid,)).fetchone()[0]
+
+def histogram_ok(cx):
+    hist = sorted(r for r in cx.execute("SELECT trophies, users FROM trophy_histogram").fetchall() if r[1])
+    return hist == sorted(cx.execute("SELECT trophies_total, COUNT(*) FROM users GROUP BY 1").fetchall())
+
+def test_reads_see_pending_writes_until_flush(wb):
+    main.set_wallet(1, "EQa")
+    main.update_trophies(1, 5)
+    main.update_trophies(1, 7)
+    assert stored(wb, 1, "wallet_address") is None and stored(wb, 1, "trophies_total") == 0
+    assert main.get_user(1)[2] == "EQa" and main.get_user(1)[5] == 7
+    assert main._pending_writes == {1: {"wallet_address": "EQa", "trophies_total": 7}}
+    assert main.flush_user_writes() == 1
+    assert stored(wb, 1, "wallet_address") == "EQa" and stored(wb, 1, "trophies_total") == 7
+    assert main._pending_writes == {} and main._flushing_writes == {}
+    assert histogram_ok(wb)
+
+def test_direct_write_in_tx_discards_pending(wb):
+    main.update_trophies(1, 5)
+    with main.tx():
+        main.update_trophies(1, 11)
+    assert main.get_user(1)[5] == 11
+    main.flush_user_writes()
+    assert stored(wb, 1, "trophies_total") == 11 and histogram_ok(wb)
+
+def test_batch_total_overrides_older_pending_total(wb):
+    main.update_trophies(1, 10)
+    main.update_trophies_many({1: 20})
+    assert main.get_user(1)[5] == 20
+    main.flush_user_writes()
+    assert stored(wb, 1, "trophies_total") == 20 and histogram_ok(wb)
+
+def test_batch_delta_applies_to_pending_total(wb):
+    main.update_trophies(1, 10)
+    assert main.update_trophies_many({}, {1: 3}) == {1: 13}
+    main.flush_user_writes()
+    assert stored(wb, 1, "trophies_total") == 13 and histogram_ok(wb)
+
+def test_failed_flush_requeues_under_newer_writes(wb, monkeypatch):
+    main.set_wallet(2, "A")
+    main.update_trophies(2, 20)
+    update_trophies_many = main.update_trophies_many
+    def boom(*args, **kwargs):
+        raise RuntimeError("panne")
+    monkeypatch.setattr(main, "update_trophies_many", boom)
+    with pytest.raises(RuntimeError):
+        main.flush_user_writes()
+    assert stored(wb, 2, "wallet_address") is None
+    main.set_wallet(2, "B")
+    assert main._pending_writes == {2: {"wallet_address": "B", "trophies_total": 20}}
+    monkeypatch.setattr(main, "update_trophies_many", update_trophies_many)
+    main.flush_user_writes()
+    assert stored(wb, 2, "wallet_address") == "B" and stored(wb, 2, "trophies_total") == 20
+
+def test_delete_user_discards_pending(wb):
+    main.update_trophies(2, 3)
+    main.delete_user(2)
+    assert main._pending_writes == {}
+    assert main.flush_user_writes() == 0
+    assert main.get_user(2) is None